@@ -6,7 +6,9 @@ import data_processing
 
 
 """
-Augment and save the dataset. Augments are rotation and flipping. Fake colors are added too. Saved as .tif files. 
+Augment and save the dataset. Augments are rotation and flipping. Fake colors are added too. Saved as .tif files.
+Superseded by the on the fly augmentation of input_pipeline.AugmentedSequence (used by pretrained_unet.run), which
+augments each batch while training instead of writing 12 copies of every image to disk.
 """
 
 
@@ -0,0 +1,19 @@
+import model_utils
+import pretrained_unet
+import sys
+
+"""
+Converts a trained vgg16_unet model with 3 input channels (fake colors) to a model with 1 input channel. The kernels of
+the first conv layer are summed over the color channels, so the predictions are the same but the gray scale images
+don't have to be copied to 3 channels.
+Usage: python convert_to_single_channel.py model_path output_model_path
+"""
+
+if __name__ == '__main__':
+    model_path = sys.argv[1]
+    output_model_path = sys.argv[2]
+
+    model = model_utils.load_model(model_path)
+    single_channel_model = pretrained_unet.convert_to_single_channel(model)
+    single_channel_model.save(output_model_path)
+    print(f"Wrote the single channel model to {output_model_path}")
@@ -14,12 +14,8 @@ def get_class_distribution(image, n_classes=6):
     :param image: numpy array of the image
     :return: List with the num of each class
     """
-    result = []
-    for i in range(n_classes):
-        is_class = image == i
-        num_of_class = np.sum(is_class)
-        result.append(num_of_class)
-    return np.array(result)
+    # One pass over the image, the last bin has the pixels of other values
+    return data_processing.class_histogram(image, n_classes=n_classes)[:n_classes]
 
 
 def analyse_labels(image_dir):
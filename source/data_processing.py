@@ -10,6 +10,10 @@ import copy
 import random
 import pandas as pd
 import shutil
+import raster_io
+import spatial_index
+import tile_store
+import tiling
 
 """
 Look here for tips:
@@ -18,6 +22,7 @@ https://pcjericks.github.io/py-gdalogr-cookbook/geometry.html
 
 # GLOBAL CONSTANTS
 UNKNOWN_CLASS_ID = 5
+N_LABEL_CLASSES = 6
 
 class TrainingImage:
     """
@@ -52,36 +57,24 @@ class TrainingImage:
         self.north_offset = north_offset
         self.east_offset = east_offset
 
-    def _write_array_to_raster(self, output_filepath, array, geo_transform):
+    def _write_array_to_raster(self, output_filepath, array, geo_transform, profile=raster_io.DEFAULT_PROFILE):
         """
         Writes the given array to a raster image
         :param output_filepath: The output file
+        :param profile: The raster_io.RasterProfile (data type, tiling, compression and overviews) of the output.
         :return: Nothing
         """
-        bands = array.shape[-1] if len(array.shape) > 2 else 1
-        driver = gdal.GetDriverByName("GTiff")
-        raster = driver.Create(output_filepath, array.shape[1], array.shape[0],
-                      bands, gdal.GDT_Int16)
-        raster.SetGeoTransform(geo_transform)
-        raster.SetProjection(self.projection)
-        # Write multiple bands
-        if len(array.shape) > 2:
-            for band in range(array.shape[-1]):
-                raster.GetRasterBand(band + 1).WriteArray(array[:,:,band])
-        # Write single band
-        else:
-            raster.GetRasterBand(1).WriteArray(array)
-        raster = None
+        raster_io.write_raster(output_filepath, array, geo_transform, self.projection, profile=profile)
 
-    def write_data_to_raster(self, output_filepath):
-        self._write_array_to_raster(output_filepath, self.data, self.geo_transform)
+    def write_data_to_raster(self, output_filepath, profile=raster_io.DEFAULT_PROFILE):
+        self._write_array_to_raster(output_filepath, self.data, self.geo_transform, profile=profile)
 
-    def write_labels_to_raster(self, output_filepath):
+    def write_labels_to_raster(self, output_filepath, profile=raster_io.DEFAULT_PROFILE):
         if self.label_geo_transform is not None:
             geo_transform = self.label_geo_transform
         else:
             geo_transform = self.geo_transform
-        self._write_array_to_raster(output_filepath, self.labels, geo_transform)
+        self._write_array_to_raster(output_filepath, self.labels, geo_transform, profile=profile)
 
 
 def create_pointer_files(data_path, output_folder, train_size=0.6, valid_size=0.2, test_size=0.2, shuffle=True,
@@ -124,6 +117,59 @@ def create_pointer_files(data_path, output_folder, train_size=0.6, valid_size=0.
         f.write("\n".join(pairs))
 
 
+def class_histogram(label_image, n_classes=N_LABEL_CLASSES):
+    """
+    Counts the pixels of each class in a label image.
+    :param label_image: A numpy matrix representing the label image
+    :param n_classes: The number of classes. Pixels with other values are counted in an extra last bin.
+    :return: A numpy array with n_classes + 1 counts
+    """
+    class_ids = np.asarray(label_image).ravel().astype(np.int64)
+    class_ids[(class_ids < 0) | (class_ids > n_classes)] = n_classes
+    return np.bincount(class_ids, minlength=n_classes + 1)
+
+
+def tile_class_histograms(label_matrix, north_offsets, east_offsets, tile_size, n_classes=N_LABEL_CLASSES):
+    """
+    Counts the pixels of each class in every tile of a label image. Each band of rows is scanned once with bincount,
+    counting per class and column, and the counts of the tiles are the differences of the cumulative column counts.
+    :param label_matrix: A numpy matrix representing the (big) label image
+    :param north_offsets: The offsets in pixels from the north edge of the tile rows
+    :param east_offsets: The offsets in pixels from the east edge of the tile columns
+    :param tile_size: The size of the tiles in pixels
+    :param n_classes: The number of classes. Pixels with other values are counted in an extra last bin.
+    :return: A numpy array with shape (len(north_offsets), len(east_offsets), n_classes + 1) with the counts
+    """
+    width = label_matrix.shape[1]
+    east_offsets = np.asarray(east_offsets)
+    histograms = np.zeros((len(north_offsets), len(east_offsets), n_classes + 1), dtype=np.int64)
+    columns = np.arange(width, dtype=np.int64)
+    for i, north_offset in enumerate(north_offsets):
+        class_ids = label_matrix[north_offset:north_offset + tile_size].astype(np.int64)
+        class_ids[(class_ids < 0) | (class_ids > n_classes)] = n_classes
+        # Count each (class, column) pair
+        counts = np.bincount((class_ids * width + columns).ravel(), minlength=(n_classes + 1) * width)
+        counts = counts.reshape(n_classes + 1, width)
+        cumulative = np.zeros((n_classes + 1, width + 1), dtype=np.int64)
+        np.cumsum(counts, axis=1, out=cumulative[:, 1:])
+        histograms[i] = (cumulative[:, east_offsets + tile_size] - cumulative[:, east_offsets]).T
+    return histograms
+
+
+def quality_mask(histograms, unknown_threshold=0.05):
+    """
+    Finds the tiles that pass the quality check of is_quality_image from their class histograms.
+    :param histograms: A numpy array with class histograms along the last axis, see tile_class_histograms
+    :param unknown_threshold: The max ratio of the unknown class
+    :return: A bool numpy array with the shape of histograms without the last axis, true for the tiles that pass
+    """
+    n_pixels = np.sum(histograms, axis=-1)
+    above_unknown_threshold = histograms[..., UNKNOWN_CLASS_ID] > unknown_threshold * n_pixels
+    # Only one class, the extra bin with other values does not count as a class
+    mono_class = np.any(histograms[..., :-1] == n_pixels[..., np.newaxis], axis=-1)
+    return ~above_unknown_threshold & ~mono_class
+
+
 def is_above_unknown_threshold(label_image, unknown_threshold=0.1):
     # Check that the amount of the unknown class
     unknown_label_matrix = label_image == UNKNOWN_CLASS_ID
@@ -133,16 +179,8 @@ def is_above_unknown_threshold(label_image, unknown_threshold=0.1):
         return False
 
 def is_mono_class(label_image):
-    for i in range(6):
-        is_mono_class = True
-        for e in np.nditer(label_image):
-            if e != i:
-                is_mono_class = False
-                break
-        # The image had only one class
-        if is_mono_class:
-            return True
-    return False
+    # Only one of the classes 0 to 5 in the image
+    return bool(np.any(class_histogram(label_image)[:-1] == np.size(label_image)))
 
 def is_quality_image(label_image, unknown_threshold=0.05):
     """
@@ -150,17 +188,24 @@ def is_quality_image(label_image, unknown_threshold=0.05):
     :param label_image: A numpy matrix representing the label image
     :return: bool, true if the image passes the check, 0 otherwise
     """
-    # Discard images with more than a threshold of the unknown class
-    if is_above_unknown_threshold(label_image, unknown_threshold):
-        return False
-    # Discard images with only one class
-    if is_mono_class(label_image):
-        return False
-
-    return True
+    # Discard images with more than a threshold of the unknown class, or with only one class
+    return bool(quality_mask(class_histogram(label_image), unknown_threshold))
 
 
-def divide_image(image_filepath, label_filepath, image_size=512, do_overlap=False, do_crop=False):
+def tile_image(image_filepath, label_filepath, image_size=512, do_overlap=False, do_crop=False, filter_tiles=True):
+    """
+    Splits a big image and its labels into tiles without copying them. The tiles are views into the big image, see
+    tiling.TileGrid.
+    :param image_filepath: The path to the big image
+    :param label_filepath: The path to the label raster of the big image
+    :param image_size: The size of the tiles in pixels
+    :param do_overlap: Let the tiles overlap, with a distance of a quarter tile between them
+    :param do_crop: Only keep the labels of the center of the tiles
+    :param filter_tiles: Only keep the tiles that pass the quality check (see is_quality_image)
+    :return: A tuple with (image_grid, label_grid, histograms) where the grids are tiling.TileGrid objects with the
+    same tiles and histograms is a numpy array with shape (number of tiles, N_LABEL_CLASSES + 1) with the pixel count
+    of each class in the labels of each tile
+    """
     # Load image
     image_ds = gdal.Open(image_filepath)
     geo_transform = image_ds.GetGeoTransform()
@@ -175,7 +220,6 @@ def divide_image(image_filepath, label_filepath, image_size=512, do_overlap=Fals
     label_matrix = label_ds.GetRasterBand(1).ReadAsArray()
     label_ds = None
 
-    training_data = []
     # Make properly sized training data
     # Make sure that the whole image is covered, even if the last one has to overlap
     if do_overlap:
@@ -186,48 +230,66 @@ def divide_image(image_filepath, label_filepath, image_size=512, do_overlap=Fals
         shape_0_indices[-1] = image_matrix.shape[0] - image_size
         shape_1_indices = list(range(0, image_matrix.shape[1], image_size))
         shape_1_indices[-1] = image_matrix.shape[1] - image_size
-    # Split the images
-    for shape_0 in shape_0_indices:
-        for shape_1 in shape_1_indices:
-            if do_crop:
-                # Extract labels for the center of the image
-                labels = label_matrix[shape_0 + image_size // 4:shape_0 + image_size - image_size // 4,
-                         shape_1 + image_size // 4:shape_1 + image_size - image_size // 4]
-            else:
-                labels = label_matrix[shape_0:shape_0 + image_size, shape_1:shape_1 + image_size]
-            # Check if the image has to much unknown
-            if not is_quality_image(labels):
-                continue
-
-            # Calculate the geo transform of the label
-            label_geo_transform = list(geo_transform)
-            if do_crop:
-                label_geo_transform[0] += (shape_1 + image_size//4) * geo_transform[1]  # East
-                label_geo_transform[3] += (shape_0 + image_size//4) * geo_transform[5]  # North
-            else:
-                label_geo_transform[0] += (shape_1) * geo_transform[1]  # East
-                label_geo_transform[3] += (shape_0) * geo_transform[5]  # North
-
-            data = image_matrix[shape_0:shape_0 + image_size, shape_1:shape_1 + image_size]
-            new_data_geo_transform = list(geo_transform)
-            new_data_geo_transform[0] += shape_1 * geo_transform[1]  # East
-            new_data_geo_transform[3] += shape_0 * geo_transform[5]  # North
-
-            name = os.path.split(image_filepath)[-1].replace(".tif", "") + f"_n_{shape_0}_e_{shape_1}"
-            training_data.append(TrainingImage(data, labels, new_data_geo_transform, name=name, projection=projection,
-                                               label_geo_transform=label_geo_transform, east_offset=shape_1,
-                                               north_offset=shape_0))
+    name = os.path.split(image_filepath)[-1].replace(".tif", "")
+    image_grid = tiling.TileGrid.from_offsets(image_matrix, image_size, shape_0_indices, shape_1_indices,
+                                              geo_transform=geo_transform, projection=projection, name=name)
+    label_grid = tiling.TileGrid.from_offsets(label_matrix, image_size, shape_0_indices, shape_1_indices,
+                                              geo_transform=geo_transform, projection=projection, name=name)
+    # The labels of the tiles, only the center of the tiles when cropping
+    label_offset = image_size // 4 if do_crop else 0
+    label_grid = label_grid.crop(label_offset)
+    # Check the quality of all the tiles at once
+    histograms = tile_class_histograms(label_matrix, [i + label_offset for i in shape_0_indices],
+                                       [i + label_offset for i in shape_1_indices], label_grid.tile_size)
+    histograms = histograms.reshape(-1, histograms.shape[-1])
+    if filter_tiles:
+        # Discard tiles with to much unknown or only one class
+        is_quality = quality_mask(histograms)
+        image_grid = image_grid.select(is_quality)
+        label_grid = label_grid.select(is_quality)
+        histograms = histograms[is_quality]
+    return image_grid, label_grid, histograms
+
+
+def divide_image(image_filepath, label_filepath, image_size=512, do_overlap=False, do_crop=False,
+                 return_histograms=False):
+    """
+    Splits a big image and its labels into tiles, and keeps the tiles that pass the quality check (see
+    is_quality_image). Use tile_image to get the tiles without making a TrainingImage per tile.
+    :param image_filepath: The path to the big image
+    :param label_filepath: The path to the label raster of the big image
+    :param image_size: The size of the tiles in pixels
+    :param do_overlap: Let the tiles overlap, with a distance of a quarter tile between them
+    :param do_crop: Only keep the labels of the center of the tiles
+    :param return_histograms: Also return the class histograms of the kept labels
+    :return: A list of TrainingImage objects. With return_histograms, also a numpy array with shape
+    (number of tiles, N_LABEL_CLASSES + 1) with the pixel count of each class in the labels of each tile
+    """
+    image_grid, label_grid, histograms = tile_image(image_filepath, label_filepath, image_size=image_size,
+                                                    do_overlap=do_overlap, do_crop=do_crop)
+    training_data = []
+    for i in range(len(image_grid)):
+        north_offset, east_offset = image_grid.offsets[i]
+        training_data.append(TrainingImage(image_grid[i], label_grid[i], image_grid.tile_geo_transform(i),
+                                           name=image_grid.tile_name(i), projection=image_grid.projection,
+                                           label_geo_transform=label_grid.tile_geo_transform(i),
+                                           east_offset=int(east_offset), north_offset=int(north_offset)))
+    if return_histograms:
+        return training_data, histograms
     return training_data
 
 
 def divide_and_save_images(image_filepaths, label_filepaths, output_folder=None, image_size=512,
-                           do_overlap=False, do_crop=False):
+                           do_overlap=False, do_crop=False, profile=raster_io.DEFAULT_PROFILE, output_format="tif"):
     """
     This function takes big images and splits them into smaller images and saves them to disk
     :param image_filepaths: A list of filepaths to the images that will be loaded
     :param label_filepaths: A list of filepaths to the label (rasters) that will be loaded
     :param output_folder: The folder where the new rasters will be saved. If it is None, the files will not be saved
     :param image_size: The size of the new images, measured in pixels
+    :param profile: The raster_io.RasterProfile (data type, tiling, compression and overviews) of the new rasters
+    :param output_format: tif: a GeoTIFF per image and label in the images and labels subfolders. tile_store: the
+    tiles are written to a few binary shards in the output folder, see tile_store.py
     :return: list of TrainingImage objects
     """
 
@@ -235,9 +297,18 @@ def divide_and_save_images(image_filepaths, label_filepaths, output_folder=None,
     if len(image_filepaths) != len(label_filepaths):
         raise Exception(f"The image filepaths and label filepaths must be in sync,"
                         f" but their lengths did not match. {len(image_filepaths)} != {len(label_filepaths)}")
+    if output_format not in ("tif", "tile_store"):
+        raise ValueError(f"The output format must be tif or tile_store, it was {output_format}")
     # Load the images
     # Write the images to disk
-    if output_folder is not None:
+    if output_folder is not None and output_format == "tile_store":
+        writer = tile_store.TileStoreWriter(output_folder)
+        for i in range(len(image_filepaths)):
+            image_grid, label_grid, _ = tile_image(image_filepaths[i], label_filepaths[i], image_size=image_size,
+                                                   do_overlap=do_overlap, do_crop=do_crop)
+            writer.add_grids(image_grid, label_grid)
+        writer.close()
+    elif output_folder is not None:
         # Make output folders
         os.makedirs(os.path.join(output_folder, "images"), exist_ok=True)
         os.makedirs(os.path.join(output_folder, "labels"), exist_ok=True)
@@ -247,13 +318,20 @@ def divide_and_save_images(image_filepaths, label_filepaths, output_folder=None,
             for image in training_images:
                 # Data
                 data_path = os.path.join(output_folder, "images", image.name + ".tif")
-                image.write_data_to_raster(data_path)
+                image.write_data_to_raster(data_path, profile=profile)
                 # Labels
                 label_path = os.path.join(output_folder, "labels", image.name + ".tif")
-                image.write_labels_to_raster(label_path)
+                image.write_labels_to_raster(label_path, profile=profile)
 
 
 def find_intersecting_polys(geometry, polys):
+    """
+    :param geometry: A gdal geometry, e.g. the bounding box of an image.
+    :param polys: A spatial_index.PolygonIndex or a list of gdal geometries.
+    :return: A list with the polygons that intersect the geometry.
+    """
+    if isinstance(polys, spatial_index.PolygonIndex):
+        return polys.query(geometry)
     intersecting_polys = []
     for poly in polys:
         if poly.Intersects(geometry):
@@ -306,6 +384,82 @@ def rasterize_polygons(polygons, image_path, class_name, shapefile_path, driver=
     return label_raster
 
 
+def _class_union(polygons):
+    # The union of the polygons of a class, so overlapping polygons of the same class cover a pixel once
+    multi_polygon = ogr.Geometry(ogr.wkbMultiPolygon)
+    for poly in polygons:
+        if ogr.GT_Flatten(poly.GetGeometryType()) == ogr.wkbMultiPolygon:
+            for i in range(poly.GetGeometryCount()):
+                multi_polygon.AddGeometry(poly.GetGeometryRef(i))
+        else:
+            multi_polygon.AddGeometry(poly)
+    return multi_polygon.UnionCascaded()
+
+
+def rasterize_classes(class_polygons, image_ds):
+    """
+    Burns the polygons of all the classes into one band of one MEM raster, with one RasterizeLayer call. Every class
+    has a bit, 2 ** (the position of the ID in the sorted IDs), and the polygons of each class are merged into one
+    feature that burns its bit with MERGE_ALG=ADD. A pixel value is then the bit flags of the classes that cover it,
+    the same coverage as the per class rasters of rasterize_polygons. See resolve_class_flags.
+    :param class_polygons: A dict with class_ID -> list of polygons (can be empty)
+    :param image_ds: An open gdal dataset that defines the size and georeferencing of the raster.
+    :return: A numpy array with the class bit flags of each pixel, uint8 for up to 8 classes, else uint16.
+    """
+    s_IDs = sorted(class_polygons.keys())
+    if len(s_IDs) > 16:
+        raise ValueError(f"At most 16 classes can be rasterized in one pass, there were {len(s_IDs)}")
+    data_type = gdal.GDT_Byte if len(s_IDs) <= 8 else gdal.GDT_UInt16
+    raster = gdal.GetDriverByName("MEM").Create("", image_ds.RasterXSize, image_ds.RasterYSize, 1, data_type)
+    raster.SetGeoTransform(image_ds.GetGeoTransform())
+    raster.SetProjection(image_ds.GetProjection())
+
+    # One memory layer with one feature per class that has the bit of the class as an attribute
+    poly_ds = ogr.GetDriverByName("Memory").CreateDataSource("class_polygons")
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(25833)
+    layer = poly_ds.CreateLayer("class_polygons", srs, ogr.wkbMultiPolygon)
+    layer.CreateField(ogr.FieldDefn("class_bit", ogr.OFTInteger))
+    for position, class_id in enumerate(s_IDs):
+        if len(class_polygons[class_id]) == 0:
+            continue
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField("class_bit", 2 ** position)
+        feature.SetGeometry(_class_union(class_polygons[class_id]))
+        layer.CreateFeature(feature)
+        feature.Destroy()
+
+    gdal.RasterizeLayer(raster, (1,), layer, options=["ATTRIBUTE=class_bit", "MERGE_ALG=ADD"])
+    poly_ds.Destroy()
+    class_flags = raster.GetRasterBand(1).ReadAsArray()
+    raster = None
+    return class_flags
+
+
+def resolve_class_flags(class_flags, n_classes):
+    """
+    Makes the label matrix from the class bit flags of rasterize_classes, with the same rules as merge_label_arrays. A
+    pixel with one class gets that class, a pixel with multiple classes gets the lowest class (the lowest set bit) and
+    a pixel with no class gets the majority class of its neighborhood (see find_closest_pixel).
+    :param class_flags: A numpy array with the class bit flags of each pixel.
+    :param n_classes: The number of classes (bits).
+    :return: A numpy array with the class of each pixel.
+    """
+    # The lowest set bit of every possible value, the unknown class for 0 (filled below)
+    values = np.arange(2 ** n_classes)
+    lowest_bit = np.full(len(values), UNKNOWN_CLASS_ID, dtype=np.uint8)
+    for bit in reversed(range(n_classes)):
+        lowest_bit[(values >> bit) & 1 == 1] = bit
+    label_matrix = lowest_bit[class_flags]
+
+    is_empty = class_flags == 0
+    if np.any(is_empty):
+        # The coverage of one class at a time, as the per class rasters
+        arrays = (((class_flags >> bit) & 1).astype(np.uint8) for bit in range(n_classes))
+        label_matrix[is_empty] = _neighborhood_majority(arrays, is_empty)
+    return label_matrix
+
+
 def find_closest_pixel(i, j, arrays, threshold=10):
     """
 
@@ -357,7 +511,7 @@ def find_closest_pixel(i, j, arrays, threshold=10):
 
 
 def reassemble_big_image(images, small_image_size=512, big_image_shape=(6000, 8000)):
-    big_image = np.zeros(big_image_shape) + 5
+    big_image = np.full(big_image_shape, UNKNOWN_CLASS_ID, dtype=np.uint8)
     for image in images:
         image_offset_shape_0 = image.north_offset
         image_offset_shape_1 = image.east_offset
@@ -365,12 +519,63 @@ def reassemble_big_image(images, small_image_size=512, big_image_shape=(6000, 80
                   image_offset_shape_1:image_offset_shape_1+small_image_size] = image.labels
     return big_image
 
-def merge_labels_rasters(label_raster_dict):
+def _neighborhood_majority(arrays, mask, threshold=10, strip_rows=256):
+    """
+    Vectorized find_closest_pixel for all the pixels in the mask. For each pixel the values of each class array are
+    summed over a window around the pixel and the class with the largest sum is chosen. The window sums come from int32
+    integral images of strips of rows, so the memory used is bounded by the strip size and not by the number of pixels
+    in the mask.
+    :param arrays: arrays with labels (None is equivalent with a zero array). Can be a generator, each array is used once.
+    :param mask: A boolean numpy array with True at the pixels to find the class for.
+    :param threshold: The (max) distance in pixels that are searched
+    :param strip_rows: The number of rows of the mask in each strip.
+    :return: A numpy array with the class of each pixel in the mask (in the order of np.nonzero). The unknown class if
+    no class was in the search area.
     """
+    shape = mask.shape
+    n_pixels = np.count_nonzero(mask)
+    best_count = np.zeros(n_pixels, dtype=np.int32)
+    best_id = np.full(n_pixels, UNKNOWN_CLASS_ID, dtype=np.uint8)
+    for identifier, array in enumerate(arrays):
+        if array is None:
+            continue
+        # The position of the strip in the pixels of the mask, the strips go in the order of np.nonzero
+        position = 0
+        for strip_top in range(0, shape[0], strip_rows):
+            strip_bottom = min(strip_top + strip_rows, shape[0])
+            i, j = np.nonzero(mask[strip_top:strip_bottom])
+            if len(i) == 0:
+                continue
+            i = i.astype(np.int32) + strip_top
+            j = j.astype(np.int32)
+            # The window shrinks close to the edges, as in find_closest_pixel
+            radius = np.minimum(np.minimum(np.minimum(i, j), np.minimum(shape[0] - i - 1, shape[1] - j - 1)),
+                                threshold)
+            # The integral image of the rows the windows of the strip can reach. int32 is enough since the rasterized
+            # arrays are 0 or 1
+            first_row = max(0, strip_top - threshold)
+            last_row = min(shape[0], strip_bottom + threshold)
+            integral = np.zeros((last_row - first_row + 1, shape[1] + 1), dtype=np.int32)
+            np.cumsum(np.cumsum(array[first_row:last_row], axis=0, dtype=np.int32), axis=1,
+                      out=integral[1:, 1:])
+            top, bottom = i - radius - first_row, i + radius - first_row
+            left, right = j - radius, j + radius
+            count = integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+            # Strictly larger, so ties go to the lowest id like np.argmax
+            strip_best = best_count[position:position + len(i)]
+            is_better = count > strip_best
+            strip_best[is_better] = count[is_better]
+            best_id[position:position + len(i)][is_better] = identifier
+            position += len(i)
+    return best_id
 
-    (array = None is equivalent with a zero array but is kept as None to save computation time)
-    :param label_raster_dict:
-    :return:
+
+def merge_labels_rasters(label_raster_dict):
+    """
+    Merges the rasters of each class into one label matrix, see merge_label_arrays.
+    :param label_raster_dict: A dict with class_ID -> gdal raster (or None). The position of the ID in the sorted IDs
+    is used as the class in the label matrix.
+    :return: A numpy array with the class of each pixel.
     """
     arrays = []
     s_IDs = sorted(label_raster_dict.keys())
@@ -380,6 +585,19 @@ def merge_labels_rasters(label_raster_dict):
         else:
             array = label_raster_dict[id].GetRasterBand(1).ReadAsArray()
         arrays.append(array)
+    return merge_label_arrays(arrays)
+
+
+def merge_label_arrays(arrays):
+    """
+    Merges the arrays of each class into one label matrix. A pixel with one class gets that class, a pixel with
+    multiple classes gets the lowest id and a pixel with no class gets the majority class of its neighborhood
+    (see find_closest_pixel).
+    (array = None is equivalent with a zero array but is kept as None to save computation time)
+    :param arrays: A list with an array per class (or None), the class is the position in the list. Pixels > 0 have
+    the class.
+    :return: A numpy array with the class of each pixel.
+    """
     # Check array shapes, they should all be the same
     shape = None
     for array in arrays:
@@ -390,40 +608,34 @@ def merge_labels_rasters(label_raster_dict):
         if array is None: continue
         if array.shape != shape:
             raise Exception(f"The shapes does not match, {shape} != {array.shape}")
-    label_matrix = np.zeros(shape, dtype=int)
-    for i in range(shape[0]):
-        for j in range(shape[1]):
-            ids_at_pixel = []
-            for id, array in enumerate(arrays):
-                if array is None:
-                    continue
-                else:
-                    pixel = array[i][j]
-                    if pixel > 0:
-                        ids_at_pixel.append(id)
-            # Only one class at the location
-            if len(ids_at_pixel) == 1:
-                label_matrix[i][j] = ids_at_pixel[0]
-            # No pixels matches, will fill in with closest value
-            elif len(ids_at_pixel) == 0:
-                label_matrix[i][j] = find_closest_pixel(i, j, arrays)
-            # Multiple pixels at the same loc, take the majority
-            elif len(ids_at_pixel) > 1:
-                id_count = [0] * len(arrays)
-                # Find the majority id
-                for id in ids_at_pixel:
-                    id_count[id] += 1
-                label_matrix[i][j] = np.argmax(id_count)
-            else:
-                raise Exception("Something weird happened...")
+
+    # Going from the highest id to the lowest leaves the lowest id at pixels with multiple classes, which is the
+    # majority (argmax) when every class has one vote
+    label_matrix = np.zeros(shape, dtype=np.uint8)
+    has_class = np.zeros(shape, dtype=bool)
+    for id in reversed(range(len(arrays))):
+        if arrays[id] is None:
+            continue
+        is_class = arrays[id] > 0
+        label_matrix[is_class] = id
+        has_class |= is_class
+    # No pixels matches, will fill in with closest value
+    is_empty = ~has_class
+    del has_class
+    if np.any(is_empty):
+        label_matrix[is_empty] = _neighborhood_majority(arrays, is_empty)
     return label_matrix
 
 
-def create_raster_labels(image_path, poly_dict, destination_path, driver=gdal.GetDriverByName("GTiff")):
+def create_raster_labels(image_path, poly_dict, destination_path, driver=gdal.GetDriverByName("GTiff"),
+                         single_pass=True):
     """
     Creates a raster with all the polygons as pixel values.
     :param image_path: Path to the image that defines the bounding box
     :param poly_dict: A dict with class_ID -> class_polygons
+    :param single_pass: When True all the classes are rasterized into one band with one RasterizeLayer call (see
+    rasterize_classes) instead of one Int16 raster per class that are merged afterwards. Gives the same labels with
+    less memory and time. False for the per class rasters.
     :return:
     """
     # Skip if the image has a label image already
@@ -434,6 +646,34 @@ def create_raster_labels(image_path, poly_dict, destination_path, driver=gdal.Ge
     # Create bounding box for the image
     image_ds = gdal.Open(image_path)
     bounding_box = create_bounding_box(image_ds)
+    if single_pass:
+        label_matrix = _create_label_matrix_single_pass(image_ds, bounding_box, poly_dict)
+    else:
+        label_matrix = _create_label_matrix_per_class(image_path, bounding_box, poly_dict, destination_path)
+    if label_matrix is None:
+        # There was no overlapping polygons so there is no point in making a raster for it
+        return None
+    label_dataset = driver.Create(destination_path, image_ds.RasterXSize, image_ds.RasterYSize,
+                                  1, gdal.GDT_Int16)
+    label_dataset.SetGeoTransform(image_ds.GetGeoTransform())
+    label_dataset.SetProjection(image_ds.GetProjection())
+    label_dataset.GetRasterBand(1).WriteArray(label_matrix)
+    # Save, the gdal way
+    label_dataset = None
+    print(f"Wrote label image {image_path} to {destination_path}")
+
+
+def _create_label_matrix_single_pass(image_ds, bounding_box, poly_dict):
+    class_polygons = {}
+    for current_class in poly_dict:
+        # Find intersecting polygons
+        class_polygons[current_class] = find_intersecting_polys(bounding_box, poly_dict[current_class])
+    if all(len(polys) == 0 for polys in class_polygons.values()):
+        return None
+    return resolve_class_flags(rasterize_classes(class_polygons, image_ds), len(class_polygons))
+
+
+def _create_label_matrix_per_class(image_path, bounding_box, poly_dict, destination_path):
     label_raster_dict = {}
     for current_class in poly_dict:
         polys = poly_dict[current_class]
@@ -452,18 +692,9 @@ def create_raster_labels(image_path, poly_dict, destination_path, driver=gdal.Ge
             have_overlap = True
             break
     if not have_overlap:
-        # There was no overlapping polygons so there is no point in making a raster for it
         return None
     # Merge the different class layer to one
-    label_matrix = merge_labels_rasters(label_raster_dict)
-    label_dataset = driver.Create(destination_path, image_ds.RasterXSize, image_ds.RasterYSize,
-                                  1, gdal.GDT_Int16)
-    label_dataset.SetGeoTransform(image_ds.GetGeoTransform())
-    label_dataset.SetProjection(image_ds.GetProjection())
-    label_dataset.GetRasterBand(1).WriteArray(label_matrix)
-    # Save, the gdal way
-    label_dataset = None
-    print(f"Wrote label image {image_path} to {destination_path}")
+    return merge_labels_rasters(label_raster_dict)
 
 
 def burn_labels_to_image(image_path, shapefile_path, class_id):
@@ -532,11 +763,12 @@ def name_to_id(name):
         return None
 
 
-def load_polygons(folder_path):
+def load_polygons(folder_path, persist_index=True):
     """
-    Loads all the shapefiles in the folder into gdal geometries.
+    Loads all the shapefiles in the folder into gdal geometries, with a spatial index per shapefile.
     :param folder_path: The path to the shapefile folder
-    :return: A dict with ID -> label geometry
+    :param persist_index: Save the spatial indexes next to the shapefiles and reuse them on the next load.
+    :return: A dict with ID -> spatial_index.PolygonIndex with the label geometries
     """
     id_poly_dict = {}
     filepaths = glob.glob(os.path.join(folder_path, "*.shp"))
@@ -545,19 +777,8 @@ def load_polygons(folder_path):
         # Get the ID corresponding to the name
         last_part_of_path = os.path.split(path)[-1].replace(".shp", "")
         identifier = name_to_id(last_part_of_path.split("_")[-1])
-
-        # Load the shapefile into a geometry
-        driver = ogr.GetDriverByName("ESRI Shapefile")
-        ds = driver.Open(path, 0)
-        layer = ds.GetLayer()
-        polys = []
-        for feature in layer:
-            geom = feature.GetGeometryRef().Clone()
-            ref = osr.SpatialReference()
-            ref.ImportFromEPSG(25833)
-            geom.AssignSpatialReference(ref)
-            polys.append(geom)
-        id_poly_dict[identifier] = polys
+        # Load the shapefile into an index of geometries
+        id_poly_dict[identifier] = spatial_index.load_index(path, persist=persist_index)
     return id_poly_dict
 
 
@@ -598,6 +819,8 @@ def convert_many_to_CSV(pointer_file_dir, dest_dir):
 
 
 def process_and_rasterize_raw_data():
+    # Imported here since the job module imports this module
+    import rasterization_job
     gdal.UseExceptions()
     # Define the paths to the aerial images
     ORTO_ROOT_FOLDER_PATH = r"/home/kitkat/Master_project/flyfoto_gaula_1963"
@@ -616,12 +839,8 @@ def process_and_rasterize_raw_data():
         image_paths = glob.glob(glob_string)
         # Labels
         label_folder_path = os.path.join(LABEL_ROOT_PATH, subfolder)
-        # Get polygons
-        id_poly_dict = load_polygons(label_folder_path)
-        # Create raster labels for the area covered by the image
-        for path in image_paths:
-            create_raster_labels(path, id_poly_dict,
-                                 os.path.join(DEST_ROOT_PATH, subfolder, "label" + os.path.split(path)[-1]))
+        # Create raster labels for the area covered by the images, in parallel. Can be resumed if interrupted
+        rasterization_job.run_job(image_paths, label_folder_path, os.path.join(DEST_ROOT_PATH, subfolder))
     print("Done!")
 
 def train_valid_test_split(source_folder, dest_folder, train=0.8, valid=0.2, test=0, split_by_big_images=False):
@@ -707,24 +926,14 @@ def experiment_7_extra_filter(poly_path, image_dir, dest_dir):
     """
     os.makedirs(dest_dir, exist_ok=True)
     image_paths = glob.glob(os.path.join(image_dir, "*.tif"))
-    driver = ogr.GetDriverByName("ESRI Shapefile")
-    shape_ds = driver.Open(poly_path, 0)
-    layer = shape_ds.GetLayer()
-    polys = []
-    for feature in layer:
-        geom = feature.GetGeometryRef().Clone()
-        ref = osr.SpatialReference()
-        ref.ImportFromEPSG(25833)
-        geom.AssignSpatialReference(ref)
-        polys.append(geom)
+    polys = spatial_index.PolygonIndex(spatial_index.load_shapefile(poly_path))
 
     for path in image_paths:
         image_ds = gdal.Open(path)
         image_bounding_box = create_bounding_box(image_ds)
-        for poly in polys:
-            if image_bounding_box.Intersects(poly):
-                shutil.copy(path, os.path.join(dest_dir, os.path.split(path)[-1]))
-                break
+        image_ds = None
+        if polys.intersects_any(image_bounding_box):
+            shutil.copy(path, os.path.join(dest_dir, os.path.split(path)[-1]))
 
 
 def divide_and_filter_main():
@@ -0,0 +1,53 @@
+import model_utils
+import tflite_utils
+import metrics
+import time
+import sys
+
+"""
+Exports a trained model to TFLite and compares the TFLite model with the keras model on a validation set. The
+confusion matrices, the intersection over union per class, the miou and the throughput of both models are printed.
+The TFLite model can be used by run_predictions.py by giving the .tflite file as the model path.
+Usage: python export_tflite.py model_path output_path quantization calibration_data_folder [val_data_folder]
+quantization is none, float16 or int8. The data folders must have a subfolder called images (and labels for the
+validation set) with tiles in .tif format.
+"""
+
+
+def evaluate(model, val_X, val_y, num_classes):
+    start_time = time.time()
+    conf_mat, miou = model_utils.evaluate_model(model, val_X, val_y, num_classes=num_classes)
+    throughput = len(val_X) / (time.time() - start_time)
+    return conf_mat, miou, throughput
+
+
+if __name__ == '__main__':
+    model_path = sys.argv[1]
+    output_path = sys.argv[2]
+    quantization = sys.argv[3]
+    calibration_data_folder = sys.argv[4]
+    val_data_folder = sys.argv[5] if len(sys.argv) >= 6 else None
+
+    model = model_utils.load_model(model_path)
+    tflite_utils.export_tflite(model, output_path, quantization=quantization,
+                               calibration_data_folder=calibration_data_folder)
+    print(f"Wrote the TFLite model to {output_path}")
+
+    if val_data_folder is not None:
+        val = model_utils.load_dataset(val_data_folder)
+        val_X, val_y = model_utils.convert_training_images_to_numpy_arrays(val, n_channels=model.input_shape[-1])
+        del val
+        val_y = model_utils.replace_class(val_y, class_id=5)
+        num_classes = model.output_shape[-1]
+
+        print("Keras model")
+        keras_conf_mat, keras_miou, keras_throughput = evaluate(model, val_X, val_y, num_classes)
+        print(f"TFLite model ({quantization})")
+        tflite_model = model_utils.load_model(output_path)
+        tflite_conf_mat, tflite_miou, tflite_throughput = evaluate(tflite_model, val_X, val_y, num_classes)
+
+        print(f"IoU per class, keras: {metrics.class_ious(keras_conf_mat)}")
+        print(f"IoU per class, TFLite: {metrics.class_ious(tflite_conf_mat)}")
+        print(f"miou, keras: {keras_miou}, TFLite: {tflite_miou}, difference: {tflite_miou - keras_miou}")
+        print(f"Throughput, keras: {keras_throughput:.2f} tiles/s, TFLite: {tflite_throughput:.2f} tiles/s, "
+              f"speed-up: {tflite_throughput / keras_throughput:.2f}x")
@@ -0,0 +1,141 @@
+import glob
+import os
+import numpy as np
+import tensorflow as tf
+import model_utils
+
+"""
+Input pipelines for training. AugmentedSequence keeps the training set as raw uint8 tiles in memory and every batch
+is normalized, given fake colors and augmented when it is needed, so the augmented (and normalized) training set never
+exists in memory. make_dataset reads the training set from disk with tf.data.
+"""
+
+
+class AugmentedSequence(tf.keras.utils.Sequence):
+    """
+    Batches of training data for model.fit. Each batch is flipped and rotated by a random transform from
+    model_utils.DIHEDRAL_TRANSFORMS, the same transform for the images and the labels.
+    """
+
+    def __init__(self, data_X, data_y, batch_size=4, n_channels=3, dtype=np.float32,
+                 transforms=model_utils.DIHEDRAL_TRANSFORMS, shuffle=True, seed=None, repeats=1):
+        """
+        :param data_X: A uint8 numpy array with shape (n, image_size, image_size) with the images, e.g. from
+        model_utils.load_dataset_arrays.
+        :param data_y: A uint8 numpy array with shape (n, image_size, image_size) with the labels.
+        :param batch_size: The number of images in each batch.
+        :param n_channels: The number of channels the model takes, the image is copied to every channel.
+        :param dtype: The dtype of the batches of images.
+        :param transforms: The transforms to pick from, see model_utils.apply_transform. [(None, 0)] for no
+        augmentation.
+        :param shuffle: Shuffle the order of the images every epoch.
+        :param seed: The seed of the random shuffling and transforms.
+        :param repeats: The number of times each image is used per epoch, each time with its own random transform. 12
+        gives epochs of the same size as the training set augmented by model_utils.image_augmentation.
+        """
+        if len(data_X) != len(data_y):
+            raise ValueError(f"The number of images and labels did not match, {len(data_X)} != {len(data_y)}")
+        self.data_X = data_X
+        self.data_y = data_y
+        self.batch_size = batch_size
+        self.n_channels = n_channels
+        self.dtype = dtype
+        self.transforms = transforms
+        self.shuffle = shuffle
+        self.random = np.random.RandomState(seed)
+        self.indices = np.tile(np.arange(len(data_X)), repeats)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    def __getitem__(self, i):
+        # Sorted indices read the images in order, which is faster for memmaps
+        indices = np.sort(self.indices[i * self.batch_size:(i + 1) * self.batch_size])
+        batch_X, batch_y = model_utils.convert_to_model_arrays(self.data_X[indices], self.data_y[indices],
+                                                               dtype=self.dtype, n_channels=self.n_channels)
+        transform = self.transforms[self.random.randint(len(self.transforms))]
+        return (np.ascontiguousarray(model_utils.apply_transform(batch_X, transform)),
+                np.ascontiguousarray(model_utils.apply_transform(batch_y, transform)))
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.random.shuffle(self.indices)
+
+
+def list_image_label_pairs(data_folder_path, extension="png"):
+    """
+    Finds the images and the labels with the same relative paths in the images and labels subfolders.
+    :param data_folder_path: Path to the folder with the subfolders called images and labels. The images can be in
+    subfolders of these (as used by flow_from_directory).
+    :param extension: The file extension of the images.
+    :return: A tuple with (image_paths, label_paths), two sorted lists of the same length.
+    """
+    image_folder = os.path.join(data_folder_path, "images")
+    label_folder = os.path.join(data_folder_path, "labels")
+    image_paths = sorted(glob.glob(os.path.join(image_folder, "**", f"*.{extension}"), recursive=True))
+    label_paths = [os.path.join(label_folder, os.path.relpath(path, image_folder)) for path in image_paths]
+    missing = [path for path in label_paths if not os.path.isfile(path)]
+    if len(missing) > 0:
+        raise Exception(f"{len(missing)} images in {image_folder} have no label, e.g. {missing[0]}")
+    return image_paths, label_paths
+
+
+def _decode_pair(image_path, label_path):
+    image = tf.io.decode_png(tf.io.read_file(image_path), channels=1)
+    label = tf.io.decode_png(tf.io.read_file(label_path), channels=1)
+    return image, label
+
+
+def make_dataset(data_folder_path, batch_size=1, n_channels=3, image_size=512, shuffle_buffer=256, cache=False,
+                 seed=None):
+    """
+    A tf.data pipeline with the image and label pairs of a dataset folder. The files are decoded in parallel, shuffled
+    with a bounded buffer, batched, normalized and given fake colors in the graph, and prefetched while the model
+    trains. The image and label of a pair are read together, so they can't get out of sync. The dataset repeats forever,
+    use the returned number of steps per epoch.
+    :param data_folder_path: Path to the folder with the subfolders called images and labels with .png files.
+    :param batch_size: The number of images in each batch.
+    :param n_channels: The number of channels the model takes, the image is copied to every channel.
+    :param image_size: The size of the images in pixels.
+    :param shuffle_buffer: The max number of decoded images waiting to be shuffled when caching. Without a cache all
+    the file paths are shuffled before decoding. 0 for no shuffling.
+    :param cache: Keep the decoded (uint8) pairs in memory after the first epoch when True, or in files with this
+    path prefix when a string. False for no cache.
+    :param seed: The seed of the shuffling.
+    :return: A tuple with (dataset, steps_per_epoch).
+    """
+    image_paths, label_paths = list_image_label_pairs(data_folder_path)
+    if len(image_paths) == 0:
+        raise Exception(f"There are no images in {data_folder_path}")
+    autotune = tf.data.experimental.AUTOTUNE
+
+    dataset = tf.data.Dataset.from_tensor_slices((image_paths, label_paths))
+    if cache is False:
+        # Shuffle the paths, they are cheap to keep in the buffer, and decode the files in parallel
+        dataset = dataset.repeat()
+        if shuffle_buffer > 0:
+            dataset = dataset.shuffle(len(image_paths), seed=seed)
+        dataset = dataset.map(_decode_pair, num_parallel_calls=autotune)
+    else:
+        # The decoded pairs are cached, so they are shuffled after the cache with a bounded buffer
+        dataset = dataset.map(_decode_pair, num_parallel_calls=autotune)
+        dataset = dataset.cache() if cache is True else dataset.cache(cache)
+        dataset = dataset.repeat()
+        if shuffle_buffer > 0:
+            dataset = dataset.shuffle(min(shuffle_buffer, len(image_paths)), seed=seed)
+    dataset = dataset.batch(batch_size)
+
+    def prepare(images, labels):
+        # Normalize images to the range [0, 1], 2**8 because of 8 bit encoding in original
+        images = tf.cast(images, tf.float32) / (2 ** 8 - 1)
+        # Fake colors by copying the first channel
+        images = tf.tile(images, [1, 1, 1, n_channels])
+        images = tf.ensure_shape(images, [None, image_size, image_size, n_channels])
+        labels = tf.ensure_shape(labels, [None, image_size, image_size, 1])
+        return images, labels
+
+    dataset = dataset.map(prepare, num_parallel_calls=autotune)
+    dataset = dataset.prefetch(autotune)
+    steps_per_epoch = int(np.ceil(len(image_paths) / batch_size))
+    return dataset, steps_per_epoch
@@ -0,0 +1,144 @@
+import numpy as np
+
+"""
+Segmentation metrics computed from a confusion matrix. The confusion matrix is built chunk by chunk (e.g. one batch or
+one image at a time) and the matrices of different chunks or workers can be added together, so big test sets are
+scored in one pass without keeping the labels and predictions in memory.
+"""
+
+
+def confusion_matrix(y_true, y_pred, num_classes=6, mask=None):
+    """
+    A confusion matrix computed with one bincount. Pixels with classes outside [0, num_classes) are left out.
+    :param y_true: A numpy array with the true classes.
+    :param y_pred: A numpy array with the predicted classes, with the same number of elements as y_true.
+    :param num_classes: The number of classes.
+    :param mask: An optional bool numpy array with the same number of elements, only pixels where it is true count.
+    :return: A numpy array with shape (num_classes, num_classes) with the true classes as rows and the predicted
+    classes as columns.
+    """
+    y_true = np.asarray(y_true).ravel()
+    y_pred = np.asarray(y_pred).ravel()
+    if y_true.size != y_pred.size:
+        raise ValueError(f"The labels and predictions must have the same size, {y_true.size} != {y_pred.size}")
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool).ravel()
+        y_true = y_true[mask]
+        y_pred = y_pred[mask]
+    y_true = y_true.astype(np.int64)
+    y_pred = y_pred.astype(np.int64)
+    valid = (y_true >= 0) & (y_true < num_classes) & (y_pred >= 0) & (y_pred < num_classes)
+    if not np.all(valid):
+        y_true = y_true[valid]
+        y_pred = y_pred[valid]
+    return np.bincount(num_classes * y_true + y_pred, minlength=num_classes ** 2).reshape(num_classes, num_classes)
+
+
+def class_ious(conf_mat):
+    """
+    :param conf_mat: A confusion matrix with the true classes as rows and the predicted classes as columns.
+    :return: A numpy array with the intersection over union of each class, nan for classes that are neither in the
+    labels nor in the predictions.
+    """
+    intersection = np.diag(conf_mat).astype(np.float64)
+    union = np.sum(conf_mat, axis=0) + np.sum(conf_mat, axis=1) - intersection
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return intersection / union
+
+
+class ConfusionMatrix:
+    """
+    A confusion matrix that is updated with chunks of labels and predictions, and the metrics derived from it. Classes
+    that are neither in the labels nor in the predictions have nan scores and are left out of the means.
+    """
+
+    def __init__(self, num_classes=6, matrix=None):
+        """
+        :param num_classes: The number of classes.
+        :param matrix: An optional numpy array with shape (num_classes, num_classes) to start from, with the true
+        classes as rows and the predicted classes as columns.
+        """
+        self.num_classes = num_classes
+        if matrix is None:
+            matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.matrix = np.asarray(matrix, dtype=np.int64)
+        if self.matrix.shape != (num_classes, num_classes):
+            raise ValueError(f"The matrix must have shape {(num_classes, num_classes)}, it was {self.matrix.shape}")
+
+    def update(self, y_true, y_pred, mask=None):
+        """
+        Adds a chunk of labels and predictions.
+        :param y_true: A numpy array with the true classes.
+        :param y_pred: A numpy array with the predicted classes, with the same number of elements as y_true.
+        :param mask: An optional bool numpy array, only pixels where it is true count.
+        :return: This ConfusionMatrix.
+        """
+        self.matrix += confusion_matrix(y_true, y_pred, num_classes=self.num_classes, mask=mask)
+        return self
+
+    def merge(self, other):
+        """
+        Adds the counts of another confusion matrix, e.g. the partial result of a worker.
+        :param other: A ConfusionMatrix or a numpy array with the same number of classes.
+        :return: This ConfusionMatrix.
+        """
+        matrix = other.matrix if isinstance(other, ConfusionMatrix) else np.asarray(other)
+        if matrix.shape != self.matrix.shape:
+            raise ValueError(f"Can not merge a confusion matrix with shape {matrix.shape} into {self.matrix.shape}")
+        self.matrix += matrix.astype(np.int64)
+        return self
+
+    def __add__(self, other):
+        return ConfusionMatrix(self.num_classes, self.matrix.copy()).merge(other)
+
+    def class_ious(self):
+        """
+        :return: A numpy array with the intersection over union of each class.
+        """
+        return class_ious(self.matrix)
+
+    def miou(self):
+        """
+        :return: The mean intersection over union.
+        """
+        return float(np.nanmean(self.class_ious())) if np.any(self.matrix) else float("nan")
+
+    def f1_scores(self):
+        """
+        :return: A numpy array with the F1 score (dice coefficient) of each class.
+        """
+        true_positives = np.diag(self.matrix).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return 2 * true_positives / (np.sum(self.matrix, axis=0) + np.sum(self.matrix, axis=1))
+
+    def pixel_accuracy(self):
+        """
+        :return: The fraction of the pixels that are classified correctly.
+        """
+        total = np.sum(self.matrix)
+        return float(np.trace(self.matrix) / total) if total > 0 else float("nan")
+
+    def frequency_weighted_iou(self):
+        """
+        :return: The intersection over union of each class weighted by how often the class is in the labels.
+        """
+        frequencies = np.sum(self.matrix, axis=1)
+        if np.sum(frequencies) == 0:
+            return float("nan")
+        ious = np.nan_to_num(self.class_ious())
+        return float(np.sum(frequencies * ious) / np.sum(frequencies))
+
+    def summary(self):
+        """
+        :return: A dict with all the metrics, with lists instead of numpy arrays so it can be saved as json.
+        """
+        return {"miou": self.miou(), "class_ious": self.class_ious().tolist(), "f1_scores": self.f1_scores().tolist(),
+                "pixel_accuracy": self.pixel_accuracy(), "frequency_weighted_iou": self.frequency_weighted_iou(),
+                "confusion_matrix": self.matrix.tolist()}
+
+    def report(self):
+        """
+        :return: A string with the confusion matrix, the IoU per class, the mean IoU and the pixel accuracy to print.
+        """
+        return "\n".join([str(self.matrix), f"IoU per class: {self.class_ious()}",
+                          f"miou: {self.miou()}, accuracy: {self.pixel_accuracy()}"])
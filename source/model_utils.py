@@ -1,4 +1,3 @@
-import sklearn.metrics
 import tensorflow as tf
 import numpy as np
 import pandas as pd
@@ -6,7 +5,11 @@ import glob
 import sys
 import os
 import random
+import concurrent.futures
 import data_processing
+import tflite_utils
+import tile_store
+import metrics
 import gdal
 import scipy.ndimage as nd
 
@@ -40,8 +43,11 @@ def load_dataset(data_folder_path):
     :param data_folder_path: Path to the folder with a subfolders called images and labels. These subfolder should
     contain images in .tif format. A image in images should also have a corresponding image in labels with the same
     name.
+    The folder can also be a tile store (see tile_store.py), then the data and labels are memmap slices of the shards.
     :return: The dataset as a list of TrainingImage objects.
     """
+    if tile_store.is_tile_store(data_folder_path):
+        return load_tile_store(data_folder_path)
 
     file_paths = glob.glob(os.path.join(data_folder_path, "images", "*.tif"))
     file_path_endings = [os.path.split(path)[-1] for path in file_paths]
@@ -50,27 +56,158 @@ def load_dataset(data_folder_path):
     for ending in file_path_endings:
         image_path = os.path.join(data_folder_path, "images", ending)
         label_path = os.path.join(data_folder_path, "labels", ending)
-        data.append(load_data(image_path, label_path))
+        training_image = load_data(image_path, label_path)
+        if training_image is not None:
+            data.append(training_image)
+    if len(data) < len(file_path_endings):
+        print(f"Dropped {len(file_path_endings) - len(data)} of {len(file_path_endings)} images with NaN values")
 
     return data
 
 
-def convert_training_images_to_numpy_arrays(training_images, one_hot_encode=False, normalize=True):
+def _read_band_into(path, out):
+    # Reads the first band of the raster into out, returns False if the raster is missing, has another size or NaNs
+    dataset = gdal.Open(path, gdal.GA_ReadOnly)
+    if dataset is None:
+        return False
+    band = dataset.GetRasterBand(1)
+    if (dataset.RasterYSize, dataset.RasterXSize) != out.shape:
+        return False
+    if band.DataType in (gdal.GDT_Float32, gdal.GDT_Float64):
+        array = band.ReadAsArray()
+        if np.isnan(np.min(array)):
+            return False
+        out[:] = array
+    else:
+        # Read straight into the preallocated array, gdal releases the GIL while reading
+        band.ReadAsArray(buf_obj=out)
+    return True
+
+
+def _raster_shape(path):
+    # The (height, width) of the raster, None if it can't be opened
+    dataset = gdal.Open(path, gdal.GA_ReadOnly)
+    if dataset is None:
+        return None
+    return dataset.RasterYSize, dataset.RasterXSize
+
+
+def load_dataset_arrays(data_folder_path, n_threads=8, verbose=True):
     """
-    Converts the images from a list of TrainingImage objects to a numpy array for data and labels.
-    :param training_images: A list of TrainingImage objects.
-    :return: A tuple with (data_X, data_y) where data_X is a numpy array with shape (n, image_size, image_size, 1).
-    (n is the number of images). The same applies to data_y but for the labels instead of images.
-    """
-    # Training set
-    data_set_X = np.concatenate([np.expand_dims(image.data, 0) for image in training_images], 0)
-    data_set_y = np.concatenate([np.expand_dims(image.labels, 0) for image in training_images], 0)
-    # Add channel axis
-    data_set_X = np.expand_dims(data_set_X, -1)
-    data_set_y = np.expand_dims(data_set_y, -1)
-    # Normalize images to the range [0, 1]
+    Loads an entire dataset straight into two preallocated uint8 arrays, reading the images from a pool of threads. The
+    images must be 8 bit. Images that are missing a label, have another size or contain NaN values are dropped.
+    :param data_folder_path: Path to the folder with a subfolders called images and labels, see load_dataset. The
+    folder can also be a tile store (see tile_store.py).
+    :param n_threads: The number of threads reading images.
+    :param verbose: Print the progress and the number of dropped images.
+    :return: A tuple with (data_X, data_y), uint8 numpy arrays with shape (n, image_size, image_size).
+    """
+    if tile_store.is_tile_store(data_folder_path):
+        store = tile_store.TileStore(data_folder_path)
+        data_X = np.empty((len(store), store.image_size, store.image_size), dtype=np.uint8)
+        data_y = np.empty((len(store), store.label_size, store.label_size), dtype=np.uint8)
+        for shard in range(len(store.shard_sizes)):
+            start, end = store.shard_starts[shard], store.shard_starts[shard + 1]
+            data_X[start:end], data_y[start:end] = store.shard(shard)
+        return data_X, data_y
+
+    file_paths = sorted(glob.glob(os.path.join(data_folder_path, "images", "*.tif")))
+    n_images = len(file_paths)
+    if n_images == 0:
+        return np.zeros((0, 0, 0), dtype=np.uint8), np.zeros((0, 0, 0), dtype=np.uint8)
+    # The size of the images and labels from the first pair that opens, the labels are smaller than the images if they
+    # were cropped
+    image_shape, label_shape = None, None
+    for file_path in file_paths:
+        image_shape = _raster_shape(file_path)
+        label_shape = _raster_shape(os.path.join(data_folder_path, "labels", os.path.split(file_path)[-1]))
+        if image_shape is not None and label_shape is not None:
+            break
+    if image_shape is None or label_shape is None:
+        raise Exception(f"None of the {n_images} images in {data_folder_path} could be opened together with its label")
+    data_X = np.empty((n_images,) + image_shape, dtype=np.uint8)
+    data_y = np.empty((n_images,) + label_shape, dtype=np.uint8)
+
+    def read_pair(i):
+        label_path = os.path.join(data_folder_path, "labels", os.path.split(file_paths[i])[-1])
+        return _read_band_into(file_paths[i], data_X[i]) and _read_band_into(label_path, data_y[i])
+
+    is_valid = np.zeros(n_images, dtype=bool)
+    progress_step = max(1, n_images // 20)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for i, valid in enumerate(executor.map(read_pair, range(n_images))):
+            is_valid[i] = valid
+            if verbose and ((i + 1) % progress_step == 0 or i + 1 == n_images):
+                print(f"Loaded {i + 1}/{n_images} images")
+
+    # Move the valid images to the front, in place
+    valid_indices = np.flatnonzero(is_valid)
+    for j, i in enumerate(valid_indices):
+        if i != j:
+            data_X[j] = data_X[i]
+            data_y[j] = data_y[i]
+    if verbose and len(valid_indices) < n_images:
+        print(f"Dropped {n_images - len(valid_indices)} of {n_images} images that were missing, had another size "
+              f"or contained NaN values")
+    return data_X[:len(valid_indices)], data_y[:len(valid_indices)]
+
+
+def load_tile_store(data_folder_path):
+    """
+    Loads a tile store without reading the tiles, they are read from disk when they are used.
+    :param data_folder_path: Path to the tile store folder.
+    :return: The dataset as a list of TrainingImage objects.
+    """
+    store = tile_store.TileStore(data_folder_path)
+    data = []
+    for i in range(len(store)):
+        # -1 when the offsets are not known
+        north_offset, east_offset = [int(offset) if offset >= 0 else None for offset in store.offsets[i]]
+        data.append(data_processing.TrainingImage(store.image(i), store.labels(i), list(store.geo_transforms[i]),
+                                                  name=store.names[i] + ".tif", projection=store.projection(i),
+                                                  label_geo_transform=list(store.label_geo_transforms[i]),
+                                                  north_offset=north_offset, east_offset=east_offset))
+    return data
+
+
+def _prepare_model_input(data_X, normalize, n_channels):
+    # The first channel of data_X has the raw 8 bit values. Normalizes it in place and copies it to the other channels
     if normalize:
-        data_set_X = data_set_X / (2 ** 8 - 1)  # 2**8 because of 8 bit encoding in original
+        if not np.issubdtype(data_X.dtype, np.floating):
+            raise ValueError(f"Normalized data must have a float dtype, it was {data_X.dtype}")
+        # Normalize images to the range [0, 1], 2**8 because of 8 bit encoding in original
+        data_X[..., 0] /= (2 ** 8 - 1)
+    # Fake colors by copying the first channel
+    for channel in range(1, n_channels):
+        data_X[..., channel] = data_X[..., 0]
+
+
+def convert_training_images_to_numpy_arrays(training_images, one_hot_encode=False, normalize=True, dtype=None,
+                                            n_channels=1):
+    """
+    Converts the images from a list of TrainingImage objects to a numpy array for data and labels. The data is copied
+    into one preallocated array and normalized in place.
+    :param training_images: A list of TrainingImage objects.
+    :param one_hot_encode: One hot encode the labels.
+    :param normalize: Normalize the images to the range [0, 1].
+    :param dtype: The dtype of data_X, e.g. np.uint8, np.float16 or np.float32. Defaults to np.float32 when
+    normalizing and np.uint8 otherwise.
+    :param n_channels: The number of channels of data_X, the image is copied to every channel (see fake_colors).
+    :return: A tuple with (data_X, data_y) where data_X is a numpy array with shape
+    (n, image_size, image_size, n_channels). (n is the number of images). data_y is a uint8 numpy array with shape
+    (n, image_size, image_size, 1) with the labels.
+    """
+    if dtype is None:
+        dtype = np.float32 if normalize else np.uint8
+    n_images = len(training_images)
+    image_shape = training_images[0].data.shape if n_images > 0 else (0, 0)
+    label_shape = training_images[0].labels.shape if n_images > 0 else (0, 0)
+    data_set_X = np.empty((n_images,) + image_shape + (n_channels,), dtype=dtype)
+    data_set_y = np.empty((n_images,) + label_shape + (1,), dtype=np.uint8)
+    for i, image in enumerate(training_images):
+        data_set_X[i, :, :, 0] = image.data
+        data_set_y[i, :, :, 0] = image.labels
+    _prepare_model_input(data_set_X, normalize, n_channels)
 
     if one_hot_encode:
         data_set_y = tf.keras.utils.to_categorical(data_set_y, num_classes=6)
@@ -78,17 +215,141 @@ def convert_training_images_to_numpy_arrays(training_images, one_hot_encode=Fals
     return data_set_X, data_set_y
 
 
-def fake_colors(data):
+def convert_to_model_arrays(data_X, data_y, dtype=np.float32, n_channels=1, normalize=True):
+    """
+    Converts uint8 arrays from load_dataset_arrays to the input of a model. The images are copied once, into a
+    preallocated array, and normalized in place.
+    :param data_X: A uint8 numpy array with shape (n, image_size, image_size) with the images.
+    :param data_y: A uint8 numpy array with shape (n, image_size, image_size) with the labels.
+    :param dtype: The dtype of the model input, e.g. np.uint8, np.float16 or np.float32.
+    :param n_channels: The number of channels the model takes, the image is copied to every channel.
+    :param normalize: Normalize the images to the range [0, 1].
+    :return: A tuple with (data_X, data_y) where data_X is a numpy array with shape
+    (n, image_size, image_size, n_channels) and data_y is a view of the labels with shape (n, image_size, image_size, 1).
+    """
+    model_X = np.empty(data_X.shape + (n_channels,), dtype=dtype)
+    model_X[..., 0] = data_X
+    _prepare_model_input(model_X, normalize, n_channels)
+    return model_X, data_y[..., np.newaxis]
+
+
+def fake_colors(data, n_channels=3):
     """
     Adds copies of the first channel to two new channels to simulate a color image.
     :param data: A numpy array with shape (n, image_size, image_size, 1)
-    :return: A numpy array with shape (n, image_size, image_size, 3)
+    :param n_channels: The number of channels the model takes. Data with n_channels channels is returned as it is.
+    :return: A numpy array with shape (n, image_size, image_size, n_channels)
     """
+    if data.shape[-1] == n_channels:
+        # The channels are there already, e.g. from convert_training_images_to_numpy_arrays
+        return data
 
-    new_data = np.concatenate([data, data, data], -1)
+    new_data = np.concatenate([data] * n_channels, -1)
     return new_data
 
 
+# The transforms used by image_augmentation as (flip axis, number of 90 degree rotations). The flip is done first.
+AUGMENTATION_TRANSFORMS = [(None, 0), (None, 1), (None, 2), (None, 3),
+                           (1, 0), (1, 1), (1, 2), (1, 3),
+                           (2, 0), (2, 1), (2, 2), (2, 3)]
+# The 8 unique transforms of a square (rotations and flips). The last 4 of the augmentation transforms are duplicates,
+# since flipping axis 2 is the same as flipping axis 1 and rotating 180 degrees.
+DIHEDRAL_TRANSFORMS = AUGMENTATION_TRANSFORMS[:8]
+# Test time augmentation modes
+TTA_TRANSFORMS = {"fast": DIHEDRAL_TRANSFORMS, "full": AUGMENTATION_TRANSFORMS}
+
+
+def apply_transform(data, transform):
+    """
+    Flips and rotates a batch of images.
+    :param data: A numpy array with shape (n, image_size, image_size, ...)
+    :param transform: A (flip axis, number of 90 degree rotations) tuple. The flip axis can be None.
+    :return: The transformed numpy array (often a view of data).
+    """
+    flip_axis, n_rotations = transform
+    if flip_axis is not None:
+        data = np.flip(data, axis=flip_axis)
+    return np.rot90(data, k=n_rotations, axes=(1, 2))
+
+
+def invert_transform(data, transform):
+    """
+    Undoes apply_transform.
+    :param data: A numpy array with shape (n, image_size, image_size, ...)
+    :param transform: A (flip axis, number of 90 degree rotations) tuple. The flip axis can be None.
+    :return: The numpy array in the original orientation (often a view of data).
+    """
+    flip_axis, n_rotations = transform
+    data = np.rot90(data, k=-n_rotations, axes=(1, 2))
+    if flip_axis is not None:
+        data = np.flip(data, axis=flip_axis)
+    return data
+
+
+def predict_tiles(model, tiles, batch_size=8, intensity_correction=0.0, return_probabilities=False, tta=None):
+    """
+    Predicts the class of every pixel in a set of tiles. The tiles are stacked into a preallocated float32 batch so the
+    model is called once per batch instead of once per tile.
+    :param model: A keras model.
+    :param tiles: A numpy array with shape (n, image_size, image_size), a list of arrays with shape
+    (image_size, image_size) or a tiling.TileGrid. The tiles should have raw 8 bit values, they are normalized here.
+    :param batch_size: The number of images in each call to the model. With test time augmentation each tile gives one
+    image per transform, so fewer tiles go in each batch.
+    :param intensity_correction: Added to the tiles before normalizing, to adjust for differing light levels.
+    :param return_probabilities: When True the softmax output of the model is returned instead of the class ids.
+    :param tta: Test time augmentation. "fast" for the 8 unique rotations and flips, "full" for the 12 transforms of
+    image_augmentation or a list of transforms (see apply_transform). The softmax outputs of the transformed tiles are
+    transformed back and averaged. None for no test time augmentation.
+    :return: A numpy array with shape (n, image_size, image_size) with the predicted class ids, or a float32 numpy
+    array with shape (n, image_size, image_size, num_classes) if return_probabilities is True.
+    """
+    n_tiles = len(tiles)
+    if n_tiles == 0:
+        return np.zeros((0, 0, 0), dtype=np.uint8)
+    transforms = TTA_TRANSFORMS.get(tta, tta) if tta is not None else [(None, 0)]
+    n_transforms = len(transforms)
+    tiles_per_batch = max(1, batch_size // n_transforms)
+    tile_shape = tiles[0].shape
+    n_channels = model.input_shape[-1]
+    tile_batch = np.empty((min(tiles_per_batch, n_tiles),) + tile_shape + (n_channels,), dtype=np.float32)
+    if n_transforms > 1:
+        batch = np.empty((len(tile_batch) * n_transforms,) + tile_batch.shape[1:], dtype=np.float32)
+    if return_probabilities:
+        predictions = np.empty((n_tiles,) + tile_shape + (model.output_shape[-1],), dtype=np.float32)
+    else:
+        predictions = np.empty((n_tiles,) + tile_shape, dtype=np.uint8)
+
+    for start in range(0, n_tiles, tiles_per_batch):
+        n = min(tiles_per_batch, n_tiles - start)
+        for i in range(n):
+            tile_batch[i, :, :, 0] = tiles[start + i]
+        # Normalize to the range [0, 1] in place, 2**8 because of 8 bit encoding in original
+        tile_batch[:n, :, :, 0] += intensity_correction
+        tile_batch[:n, :, :, 0] /= (2 ** 8 - 1)
+        # Fake colors by copying the first channel
+        for channel in range(1, n_channels):
+            tile_batch[:n, :, :, channel] = tile_batch[:n, :, :, 0]
+
+        if n_transforms == 1:
+            prediction = np.asarray(model.predict_on_batch(tile_batch[:n]))
+        else:
+            # All the transforms of the tiles go through the model in one batch
+            for j, transform in enumerate(transforms):
+                batch[j * n:(j + 1) * n] = apply_transform(tile_batch[:n], transform)
+            output = np.asarray(model.predict_on_batch(batch[:n * n_transforms]))
+            prediction = np.zeros((n,) + output.shape[1:], dtype=np.float32)
+            for j, transform in enumerate(transforms):
+                prediction += invert_transform(output[j * n:(j + 1) * n], transform)
+            prediction /= n_transforms
+
+        if return_probabilities:
+            predictions[start:start + n] = prediction
+        else:
+            predictions[start:start + n] = np.argmax(prediction, axis=-1)
+
+    return predictions
+
+
 def image_augmentation(data):
     """
     Takes the original image matrix and add rotated images and mirrored images (with rotations).
@@ -96,19 +357,7 @@ def image_augmentation(data):
     :param data:
     :return: An numpy array with the augmented images concatenated to the data array
     """
-    rot_90 = np.rot90(data, axes=(1, 2))
-    rot_180 = np.rot90(data, k=2, axes=(1, 2))
-    rot_270 = np.rot90(data, k=3, axes=(1, 2))
-    mirror = np.flip(data, axis=1)
-    mirror_rot_90 = np.rot90(mirror, axes=(1, 2))
-    mirror_rot_180 = np.rot90(mirror, k=2, axes=(1, 2))
-    mirror_rot_270 = np.rot90(mirror, k=3, axes=(1, 2))
-    mirror2 = np.flip(data, axis=2)
-    mirror2_rot_90 = np.rot90(mirror2, axes=(1, 2))
-    mirror2_rot_180 = np.rot90(mirror2, k=2, axes=(1, 2))
-    mirror2_rot_270 = np.rot90(mirror2, k=3, axes=(1, 2))
-    augments = [data, rot_90, rot_180, rot_270, mirror, mirror_rot_90, mirror_rot_180,
-                mirror_rot_270, mirror2, mirror2_rot_90, mirror2_rot_180, mirror2_rot_270]
+    augments = [apply_transform(data, transform) for transform in AUGMENTATION_TRANSFORMS]
     augmented_image_matrix = np.concatenate(augments, axis=0)
 
     return augmented_image_matrix
@@ -129,43 +378,49 @@ def replace_class(data, class_id=5):
 
 def miou(y_true, y_pred, num_classes=6):
     """
-    The intersection over union metric. Implemented with numpy.
+    The intersection over union metric, see metrics.ConfusionMatrix.
     :param y_true: A flat numpy array with the true classes.
     :param y_pred: A flat numpy array with the predicted classes.
     :param num_classes: The number of classes.
-    :return: The mean intersection over union.
+    :return: The mean intersection over union, over the classes that are in the labels or the predictions.
     """
-    ious = []
-    for i in range(num_classes):
-        y_true_class = y_true == i
-        y_pred_class = y_pred == i
-        intersection = np.sum(np.logical_and(y_true_class, y_pred_class))
-        union = np.sum(np.logical_or(y_true_class, y_pred_class))
-        ious.append(intersection/union)
-    return np.sum(ious)/num_classes
+    return metrics.ConfusionMatrix(num_classes).update(y_true, y_pred).miou()
 
 
-def evaluate_model(model, data, labels, num_classes=6):
-    pred = model.predict(data, batch_size=1)
-    pred = np.argmax(pred, axis=-1)
+def evaluate_model(model, data, labels, num_classes=6, batch_size=8):
+    """
+    Predicts on the data one batch at a time and adds each batch to a running confusion matrix, so the memory used
+    does not grow with the size of the data.
+    :param model: A keras model.
+    :param data: A numpy array with shape (n, image_size, image_size, channels) with normalized images.
+    :param labels: A numpy array with shape (n, image_size, image_size) or (n, image_size, image_size, 1).
+    :param num_classes: The number of classes.
+    :param batch_size: The number of images in each call to the model.
+    :return: A tuple with (conf_mat, miou). The miou is the mean over the classes that are in the labels or the
+    predictions.
+    """
+    conf_mat = metrics.ConfusionMatrix(num_classes)
+    for start in range(0, len(data), batch_size):
+        batch = data[start:start + batch_size]
+        if batch.dtype != np.float32:
+            batch = batch.astype(np.float32)
+        pred = np.argmax(np.asarray(model.predict_on_batch(batch)), axis=-1)
+        conf_mat.update(labels[start:start + batch_size], pred)
 
-    f_labels = labels.flatten()
-    f_pred = pred.flatten()
+    print(conf_mat.report())
+    return conf_mat.matrix, conf_mat.miou()
 
-    conf_mat = sklearn.metrics.confusion_matrix(f_labels, f_pred)
-    mean_intersection_over_union = miou(f_labels, f_pred, num_classes=num_classes)
-    print(conf_mat)
-    print(f"miou: {mean_intersection_over_union}")
-    return conf_mat, mean_intersection_over_union
 
 def load_model(model_file_path):
     """
     Loads the model at the file path. The model must include both architecture and weights
-    :param model_file_path: The path to the model. (.hdf5 file)
+    :param model_file_path: The path to the model. (.hdf5 file, or .tflite file for the TFLite backend)
     :return: The loaded model.
     """
 
     # Load the model
+    if model_file_path.endswith(".tflite"):
+        return tflite_utils.TFLiteModel(model_file_path)
     model = tf.keras.models.load_model(model_file_path)
     return model
 
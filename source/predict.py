@@ -1,9 +1,12 @@
 import tensorflow as tf
 import model_utils
+import data_processing
+import metrics
 import numpy as np
 import glob
 import os
 import sys
+import concurrent.futures
 
 
 
@@ -24,42 +27,37 @@ def evaluate_dataset_main():
 
 def evaluate_dataset(model, data_folder_path, intensity_correction=0.0):
     val = model_utils.load_dataset(data_folder_path)
-    val_X, val_y = model_utils.convert_training_images_to_numpy_arrays(val)
+    val_X, val_y = model_utils.convert_training_images_to_numpy_arrays(val, n_channels=model.input_shape[-1])
     val_X += intensity_correction / (2**8 - 1)  # Adjust for differing light levels in training and this dataset
-    val_X = model_utils.fake_colors(val_X)
     val_y = model_utils.replace_class(val_y, class_id=5)
 
     return model_utils.evaluate_model(model, val_X, val_y, num_classes=5)
 
 
-def predict_on_image(model, image_path, intensity_correction=0.0):
+def predict_on_image(model, image_path, intensity_correction=0.0, tta=None):
     """
     Use the model to give a prediction on a image.
     :param model: A keras model.
     :param image_path: The path to a image in geotiff format. Image should be 512x512 and in black and white.
+    :param tta: Test time augmentation, see model_utils.predict_tiles. None for no test time augmentation.
     :return: The prediction image as a TrainingImage object.
     """
 
     # Load image
     training_image = model_utils.load_data(image_path, image_path)
-    data_X = model_utils.convert_training_images_to_numpy_arrays([training_image])[0]
-    data_X += intensity_correction / (2**8 - 1)  # Adjust for differing light levels in training and this dataset
-    data_X = model_utils.fake_colors(data_X)
+    prediction = model_utils.predict_tiles(model, [training_image.data], intensity_correction=intensity_correction,
+                                           tta=tta)
 
-    prediction = model.predict(data_X)
-    prediction = np.argmax(prediction, axis=-1)
-    prediction = np.squeeze(prediction)
-
-    training_image.labels = prediction
+    training_image.labels = prediction[0]
 
     return training_image
 
 
-def predict_on_images(model, image_folder, intensity_correction=0.0):
+def predict_on_images(model, image_folder, intensity_correction=0.0, tta=None):
     paths = glob.glob(os.path.join(image_folder, "*.tif"))
     predictions = []
     for path in paths:
-        predictions.append(predict_on_image(model, path, intensity_correction=intensity_correction))
+        predictions.append(predict_on_image(model, path, intensity_correction=intensity_correction, tta=tta))
 
     return predictions
 
@@ -87,21 +85,58 @@ def predict_on_image_main():
     image.write_labels_to_raster(output_path)
 
 
-def predict_and_evaluate(model_path, data_folder, output_folder, intensity_correction=0.0):
+def predict_and_evaluate(model_path, data_folder, output_folder, intensity_correction=0.0, batch_size=8, tta=None,
+                         num_classes=5, n_writers=2):
+    """
+    Predicts on a dataset, writes the predictions and computes a confusion matrix in one pass. Each tile is loaded once
+    and predicted once in batches, the predictions are written to rasters in background threads while the model works on
+    the next batch, and the confusion matrix is updated batch by batch.
+    :param model_path: The path to the model.
+    :param data_folder: Path to the folder with the subfolders images and labels (or a tile store).
+    :param output_folder: The folder the predictions, the confusion matrix and the miou are written to.
+    :param intensity_correction: Added to the images before normalizing, to adjust for differing light levels in
+    training and this dataset.
+    :param batch_size: The number of images in each call to the model.
+    :param tta: Test time augmentation, see model_utils.predict_tiles. None for no test time augmentation.
+    :param num_classes: The number of classes in the confusion matrix. Class 5 in the labels is replaced by its nearest
+    neighbor class.
+    :param n_writers: The number of threads writing the prediction rasters.
+    :return: A tuple with (conf_mat, miou).
+    """
     model = model_utils.load_model(model_path)
-
-    predictions = predict_on_images(model, os.path.join(data_folder, "images"),
-                                    intensity_correction=intensity_correction)
+    dataset = model_utils.load_dataset(data_folder)
     os.makedirs(output_folder, exist_ok=True)
-    for pred in predictions:
-        pred.write_labels_to_raster(os.path.join(output_folder, pred.name))
-
-    conf_mat, miou = evaluate_dataset(model, data_folder)
+    conf_mat = metrics.ConfusionMatrix(num_classes)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_writers) as executor:
+        pending = []
+        for start in range(0, len(dataset), batch_size):
+            batch = dataset[start:start + batch_size]
+            predictions = model_utils.predict_tiles(model, [image.data for image in batch], batch_size=batch_size,
+                                                    intensity_correction=intensity_correction, tta=tta)
+            for image, prediction in zip(batch, predictions):
+                pred = data_processing.TrainingImage(image.data, prediction, image.geo_transform, name=image.name,
+                                                     projection=image.projection)
+                pending.append(executor.submit(pred.write_labels_to_raster, os.path.join(output_folder, pred.name)))
+
+                labels = image.labels
+                if np.any(labels == 5):
+                    labels = model_utils.replace_class(labels[np.newaxis], class_id=5)[0]
+                conf_mat.update(labels, prediction)
+
+            # Wait for the older writes so the queued predictions don't pile up in memory
+            while len(pending) > 2 * batch_size:
+                pending.pop(0).result()
+        for future in pending:
+            future.result()
+
+    print(conf_mat.report())
 
     # Save conf mat as csv
-    np.savetxt(os.path.join(output_folder, "val_conf_mat.csv"), conf_mat, delimiter=",")
+    np.savetxt(os.path.join(output_folder, "val_conf_mat.csv"), conf_mat.matrix, delimiter=",")
     with open(os.path.join(output_folder, "val_miou.txt"), "w+") as f:
-        f.write(str(miou))
+        f.write(str(conf_mat.miou()))
+    return conf_mat.matrix, conf_mat.miou()
 
 
 def run_with_args():
@@ -113,7 +148,7 @@ def run_with_args():
     data_folder = sys.argv[2]
     output_folder = sys.argv[3]
     if len(sys.argv) >= 5:
-        intensity_correction = sys.argv[4]
+        intensity_correction = float(sys.argv[4])
     else:
         intensity_correction = 0.0
 
@@ -0,0 +1,205 @@
+import os
+import queue
+import threading
+import time
+import gdal
+import model_utils
+import raster_io
+import sliding_window
+
+"""
+A three stage pipeline for making predictions on many big images. A reader thread reads tiles, the calling thread
+predicts on batches of tiles and a writer thread writes the predictions to GeoTIFFs. The stages are connected by
+bounded queues, so reading and writing overlap with the predictions, also across the boundaries between images.
+"""
+
+TILE_SIZE = 512
+
+
+class _Scene:
+    """
+    A big image that goes through the pipeline.
+    """
+
+    def __init__(self, image_path, output_path):
+        self.image_path = image_path
+        self.output_path = output_path
+
+
+class _Stage:
+    """
+    Keeps track of the time a stage spends working (not waiting on the queues) and of errors in the stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.busy_time = 0.0
+        self.error = None
+
+
+def _put(item_queue, item, stop_event):
+    # Put with a timeout so the stage can give up when another stage has failed
+    while not stop_event.is_set():
+        try:
+            item_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read(scenes, tile_queue, stride, stage, stop_event):
+    try:
+        for scene in scenes:
+            start_time = time.time()
+            image_ds = gdal.Open(scene.image_path)
+            stage.busy_time += time.time() - start_time
+            if not _put(tile_queue, ("start", scene), stop_event):
+                return
+            start_time = time.time()
+            for north_offset, east_offset, tile in raster_io.iterate_tiles(image_ds, tile_size=TILE_SIZE,
+                                                                           stride=stride):
+                stage.busy_time += time.time() - start_time
+                if not _put(tile_queue, ("tile", scene, north_offset, east_offset, tile), stop_event):
+                    return
+                start_time = time.time()
+            image_ds = None
+            if not _put(tile_queue, ("end", scene), stop_event):
+                return
+    except Exception as e:
+        stage.error = e
+        stop_event.set()
+    finally:
+        _put(tile_queue, None, stop_event)
+
+
+def _write(result_queue, num_classes, stride, profile, stage, stop_event):
+    writers = {}
+    try:
+        while True:
+            item = result_queue.get()
+            if item is None:
+                break
+            if stage.error is not None:
+                # Keep emptying the queue so the prediction stage is not blocked
+                continue
+            start_time = time.time()
+            try:
+                kind, scene = item[0], item[1]
+                if kind == "start":
+                    image_ds = gdal.Open(scene.image_path)
+                    writer = raster_io.WindowedRasterWriter.create_like(scene.output_path, image_ds, profile=profile)
+                    if stride is not None:
+                        writer = sliding_window.BlendingRasterWriter(writer, image_ds.RasterXSize,
+                                                                     image_ds.RasterYSize, num_classes,
+                                                                     tile_size=TILE_SIZE)
+                    image_ds = None
+                    writers[scene] = writer
+                elif kind == "tile":
+                    _, _, north_offset, east_offset, prediction = item
+                    if stride is not None:
+                        writers[scene].add(prediction, north_offset, east_offset)
+                    else:
+                        writers[scene].write(prediction, north_offset, east_offset)
+                elif kind == "end":
+                    # Only forgotten when it is closed, so a failed close is cleaned up below
+                    writers[scene].close()
+                    del writers[scene]
+            except Exception as e:
+                stage.error = e
+                stop_event.set()
+            stage.busy_time += time.time() - start_time
+    finally:
+        # The scenes that were not finished, because a stage failed
+        for scene, writer in writers.items():
+            try:
+                writer.abort()
+            except Exception as e:
+                print(f"WARNING: could not remove the partial prediction {scene.output_path}: {e}")
+
+
+def run_pipeline(model, image_paths, output_folder, batch_size=8, intensity_correction=0.0, stride=None,
+                 tta=None, profile=raster_io.DEFAULT_PROFILE, queue_size=64):
+    """
+    Makes predictions on the big images and writes them to the output folder with the same names.
+    :param model: A keras model.
+    :param image_paths: A list of paths to big images (.tif).
+    :param output_folder: The folder where the predictions will be written.
+    :param batch_size: The number of tiles in each call to the model.
+    :param intensity_correction: Added to the images to adjust for differing light levels.
+    :param stride: The distance in pixels between overlapping tiles, see run_predictions.predict_big_image. When None
+    the tiles don't overlap.
+    :param tta: Test time augmentation, see model_utils.predict_tiles. None for no test time augmentation.
+    :param profile: The raster_io.RasterProfile (data type, tiling, compression and overviews) of the outputs.
+    :param queue_size: The max number of tiles waiting between two stages.
+    :return: A dict with stage name -> fraction of the wall time the stage was busy.
+    """
+    if stride is not None and not 0 < stride <= TILE_SIZE:
+        raise ValueError(f"The stride must be between 1 and {TILE_SIZE}, it was {stride}")
+    scenes = [_Scene(path, os.path.join(output_folder, os.path.split(path)[-1])) for path in image_paths]
+    tile_queue = queue.Queue(maxsize=queue_size)
+    result_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    read_stage = _Stage("read")
+    predict_stage = _Stage("predict")
+    write_stage = _Stage("write")
+
+    start_time = time.time()
+    reader = threading.Thread(target=_read, args=(scenes, tile_queue, stride, read_stage, stop_event), daemon=True)
+    writer = threading.Thread(target=_write, args=(result_queue, model.output_shape[-1], stride, profile,
+                                                     write_stage, stop_event), daemon=True)
+    reader.start()
+    writer.start()
+
+    # Items are kept in order, so the scene markers reach the writer after the predictions of their tiles
+    pending = []
+    n_pending_tiles = 0
+    n_tiles = 0
+    try:
+        while True:
+            try:
+                item = tile_queue.get(timeout=0.1)
+            except queue.Empty:
+                if stop_event.is_set():
+                    # Another stage failed
+                    break
+                continue
+            if item is not None:
+                pending.append(item)
+                if item[0] == "tile":
+                    n_pending_tiles += 1
+            if n_pending_tiles == batch_size or (item is None and len(pending) > 0):
+                batch_start_time = time.time()
+                tiles = [pending_item[4] for pending_item in pending if pending_item[0] == "tile"]
+                predictions = iter(model_utils.predict_tiles(model, tiles, batch_size=batch_size,
+                                                             intensity_correction=intensity_correction,
+                                                             return_probabilities=stride is not None,
+                                                             tta=tta))
+                predict_stage.busy_time += time.time() - batch_start_time
+                for pending_item in pending:
+                    if pending_item[0] == "tile":
+                        pending_item = pending_item[:4] + (next(predictions),)
+                    result_queue.put(pending_item)
+                n_tiles += n_pending_tiles
+                pending = []
+                n_pending_tiles = 0
+            if item is None:
+                break
+    except Exception as e:
+        predict_stage.error = e
+        stop_event.set()
+    finally:
+        result_queue.put(None)
+        reader.join()
+        writer.join()
+
+    for stage in (read_stage, predict_stage, write_stage):
+        if stage.error is not None:
+            raise stage.error
+
+    wall_time = time.time() - start_time
+    utilization = {stage.name: stage.busy_time / wall_time for stage in (read_stage, predict_stage, write_stage)}
+    print(f"Predicted {n_tiles} tiles in {len(scenes)} images in {wall_time:.1f} seconds")
+    for name, fraction in utilization.items():
+        print(f"{name} stage busy {100 * fraction:.1f}% of the time")
+    return utilization
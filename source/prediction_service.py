@@ -0,0 +1,224 @@
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import gdal
+import model_utils
+import raster_io
+
+"""
+A long running local service that loads the model once and makes predictions on request, so the time to import
+tensorflow and load the model is only paid once. Tiles from concurrent requests are combined into batches.
+
+Requests (JSON body):
+POST /predict_scene {"image_path": ..., "output_path": ...}  Predicts on a big image.
+POST /predict_tile {"image_path": ..., "output_path": ...}  Predicts on a 512x512 tile.
+GET /stats  Queue depth, number of batches and latency percentiles (in milliseconds) of the tile predictions.
+The predictions are written as GeoTIFFs with the geo transform and projection of the input image.
+"""
+
+TILE_SIZE = 512
+
+
+class _TileRequest:
+    """
+    A tile waiting for a prediction.
+    """
+
+    def __init__(self, tile):
+        self.tile = tile
+        self.prediction = None
+        self.error = None
+        self.submit_time = time.time()
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.prediction
+
+
+class MicroBatcher:
+    """
+    Collects tiles from concurrent requests into batches. A batch is predicted when it is full or when the oldest tile
+    in it has waited for max_latency seconds.
+    """
+
+    def __init__(self, model, batch_size=8, max_latency=0.02, intensity_correction=0.0, n_latencies=10000):
+        """
+        :param model: A keras model.
+        :param batch_size: The max number of tiles in a batch.
+        :param max_latency: The max time in seconds the first tile in a batch waits for more tiles.
+        :param intensity_correction: Added to the tiles to adjust for differing light levels.
+        :param n_latencies: The number of recent latencies kept for the statistics.
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.intensity_correction = intensity_correction
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=n_latencies)
+        # The latencies are added by the batching thread and read by the request threads
+        self.latencies_lock = threading.Lock()
+        self.n_batches = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, tile):
+        """
+        :param tile: A numpy array with shape (image_size, image_size).
+        :return: A request, call wait() on it to get the predicted class ids.
+        """
+        request = _TileRequest(tile)
+        self.requests.put(request)
+        return request
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = batch[0].submit_time + self.max_latency
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.requests.get(timeout=max(0.0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            try:
+                predictions = model_utils.predict_tiles(self.model, [request.tile for request in batch],
+                                                        batch_size=self.batch_size,
+                                                        intensity_correction=self.intensity_correction)
+                for request, prediction in zip(batch, predictions):
+                    request.prediction = prediction
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            self.n_batches += 1
+            done_time = time.time()
+            with self.latencies_lock:
+                self.latencies.extend(done_time - request.submit_time for request in batch)
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        """
+        :return: A dict with the queue depth, the number of batches and latency percentiles in milliseconds.
+        """
+        with self.latencies_lock:
+            latencies = list(self.latencies)
+        latencies = np.array(latencies) * 1000
+        percentiles = {}
+        if len(latencies) > 0:
+            percentiles = {f"p{p}": float(np.percentile(latencies, p)) for p in (50, 90, 99)}
+        return {"queue_depth": self.requests.qsize(), "batches": self.n_batches, "latency_ms": percentiles}
+
+
+def predict_scene(batcher, image_path, output_path):
+    """
+    Predicts on a big image through the batcher, one window at a time.
+    :param batcher: A MicroBatcher.
+    :param image_path: The path to the big image (.tif).
+    :param output_path: The path of the output raster.
+    :return: Nothing
+    """
+    image_ds = gdal.Open(image_path)
+    if image_ds is None:
+        raise Exception(f"Could not open the image {image_path}")
+    writer = raster_io.WindowedRasterWriter.create_like(output_path, image_ds)
+    pending = collections.deque()
+    try:
+        for north_offset, east_offset, tile in raster_io.iterate_tiles(image_ds, tile_size=TILE_SIZE):
+            pending.append((north_offset, east_offset, batcher.submit(tile)))
+            # Bound the number of tiles in flight for this request
+            if len(pending) >= 2 * batcher.batch_size:
+                north, east, request = pending.popleft()
+                writer.write(request.wait(), north, east)
+        while len(pending) > 0:
+            north, east, request = pending.popleft()
+            writer.write(request.wait(), north, east)
+    except Exception:
+        # Don't leave a partial prediction (or temporary file) behind
+        writer.abort()
+        raise
+    writer.close()
+    image_ds = None
+
+
+def predict_tile(batcher, image_path, output_path):
+    """
+    Predicts on a tile through the batcher.
+    :param batcher: A MicroBatcher.
+    :param image_path: The path to a 512x512 image (.tif).
+    :param output_path: The path of the output raster.
+    :return: Nothing
+    """
+    image = model_utils.load_data(image_path, image_path)
+    image.labels = batcher.submit(image.data).wait()
+    image.write_labels_to_raster(output_path)
+
+
+def make_handler(batcher):
+    """
+    :param batcher: A MicroBatcher.
+    :return: A request handler class for the http server.
+    """
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+
+        def _respond(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._respond(200, batcher.stats())
+            else:
+                self._respond(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            actions = {"/predict_scene": predict_scene, "/predict_tile": predict_tile}
+            if self.path not in actions:
+                self._respond(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                image_path = body["image_path"]
+                output_path = body["output_path"]
+            except (ValueError, KeyError, TypeError) as e:
+                self._respond(400, {"error": f"The body must be JSON with image_path and output_path: {e}"})
+                return
+            start_time = time.time()
+            try:
+                actions[self.path](batcher, image_path, output_path)
+            except Exception as e:
+                self._respond(500, {"error": f"{type(e).__name__}: {e}"})
+                return
+            self._respond(200, {"output_path": output_path, "seconds": time.time() - start_time})
+
+    return PredictionHandler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a local prediction service.")
+    parser.add_argument("model_path", help="Path to the trained model (.hdf5 or .tflite file)")
+    parser.add_argument("--port", type=int, default=8500, help="The port on localhost to listen on")
+    parser.add_argument("--batch_size", type=int, default=8, help="Max number of tiles in each call to the model")
+    parser.add_argument("--max_latency_ms", type=float, default=20,
+                        help="Max time a tile waits for other tiles to fill the batch")
+    parser.add_argument("--intensity_correction", type=float, default=0.0,
+                        help="Added to the images to adjust for differing light levels")
+    args = parser.parse_args()
+
+    model = model_utils.load_model(args.model_path)
+    batcher = MicroBatcher(model, batch_size=args.batch_size, max_latency=args.max_latency_ms / 1000,
+                           intensity_correction=args.intensity_correction)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(batcher))
+    print(f"Serving predictions on http://127.0.0.1:{args.port}")
+    server.serve_forever()
@@ -3,11 +3,29 @@ import numpy as np
 import os
 import datetime
 import model_utils
+import input_pipeline
 import time
 import resource
 
 
-def vgg16_unet(image_size=512, n_max_filters=512, freeze="all", context_mode=False, dropout=0.0, num_classes=5):
+def _gray_scale_conv(conv):
+    """
+    Makes a copy of a conv layer for 1 channel input by summing the kernels of the 3 color channels. The output is the
+    same as the output of the original layer on an image with the gray scale channel copied to all 3 color channels.
+    :param conv: A keras Conv2D layer with 3 input channels.
+    :return: A keras Conv2D layer with 1 input channel.
+    """
+    kernel, bias = conv.get_weights()
+    gray_conv = tf.keras.layers.Conv2D(conv.filters, kernel_size=conv.kernel_size, padding=conv.padding,
+                                       activation=conv.activation, name=conv.name + "_gray")
+    gray_conv.build((None, None, None, 1))
+    gray_conv.set_weights([np.sum(kernel, axis=2, keepdims=True), bias])
+    gray_conv.trainable = conv.trainable
+    return gray_conv
+
+
+def vgg16_unet(image_size=512, n_max_filters=512, freeze="all", context_mode=False, dropout=0.0, num_classes=5,
+               input_channels=3, weights="imagenet"):
     """
     A unet model that uses a pre-trained VGG16 CNN as the encoder part.
     :param num_classes: The number of classes
@@ -16,6 +34,9 @@ def vgg16_unet(image_size=512, n_max_filters=512, freeze="all", context_mode=Fal
     :param freeze: Specifies what layers to freeze during training. The frozen layers will not be trained.
                 all: all of the VGG16 layers are frozen. first: all but the last conv block of VGG16 is frozen.
                 none: no layers are frozen. number: freeze all conv blocks upto and including the number.
+    :param input_channels: The number of channels in the input images, 3 or 1. With 1 channel the gray scale images
+    don't need fake colors, the kernels of the first conv layer are summed over the color channels instead.
+    :param weights: The pre-trained weights of VGG16, "imagenet" or None (random weights).
     :return: A keras model
     """
 
@@ -39,12 +60,19 @@ def vgg16_unet(image_size=512, n_max_filters=512, freeze="all", context_mode=Fal
     else:
         freeze_until = 0
 
-    # Define input. It has 3 color channels since vgg is trained on a color dataset
-    input = tf.keras.Input(shape=(image_size, image_size, 3))
+    if input_channels not in (1, 3):
+        raise ValueError(f"The input must have 1 or 3 channels, not {input_channels}")
+
+    # Define input. VGG is trained on a color dataset, so with 3 channels the gray scale images need fake colors
+    input = tf.keras.Input(shape=(image_size, image_size, input_channels))
 
     # Load pre-trained model
-    vgg16 = tf.keras.applications.vgg16.VGG16(weights="imagenet",
-                                              include_top=False, input_tensor=input)
+    if input_channels == 3:
+        vgg16 = tf.keras.applications.vgg16.VGG16(weights=weights,
+                                                  include_top=False, input_tensor=input)
+    else:
+        vgg16 = tf.keras.applications.vgg16.VGG16(weights=weights, include_top=False,
+                                                  input_shape=(image_size, image_size, 3))
     for i, layer in enumerate(vgg16.layers):
         if i < freeze_until:
             layer.trainable = False
@@ -52,7 +80,8 @@ def vgg16_unet(image_size=512, n_max_filters=512, freeze="all", context_mode=Fal
     skip_connections = []
 
     # Get first conv block
-    x = vgg16.layers[1](input)  # Conv layer
+    first_conv = vgg16.layers[1] if input_channels == 3 else _gray_scale_conv(vgg16.layers[1])
+    x = first_conv(input)  # Conv layer
     x = vgg16.layers[2](x)  # Conv layer
     skip_connections.append(x)
     x = vgg16.layers[3](x)  # Pooling layer
@@ -113,9 +142,47 @@ def vgg16_unet(image_size=512, n_max_filters=512, freeze="all", context_mode=Fal
     return model
 
 
+def convert_to_single_channel(model):
+    """
+    Converts a vgg16_unet model with 3 input channels to a model with 1 input channel, by summing the kernels of the
+    first conv layer over the color channels. The predictions on gray scale images are the same (up to float rounding),
+    but the images don't need fake colors. The frozen layers and the dropout rate of the model are kept.
+    :param model: A keras model made by vgg16_unet with 3 input channels.
+    :return: A keras model with 1 input channel.
+    """
+    if model.input_shape[-1] != 3:
+        raise ValueError(f"The model must have 3 input channels, it has {model.input_shape[-1]}")
+    old_layers = [layer for layer in model.layers if len(layer.get_weights()) > 0]
+    image_size = model.input_shape[1]
+    # The decoder starts after the last pooling layer of VGG16, its first conv layer has n_max_filters filters
+    layer_names = [layer.name for layer in model.layers]
+    if "block5_pool" not in layer_names:
+        raise ValueError("The model does not have the vgg16_unet architecture")
+    decoder_layers = model.layers[layer_names.index("block5_pool") + 1:]
+    n_max_filters = next(layer for layer in decoder_layers if isinstance(layer, tf.keras.layers.Conv2D)).filters
+    dropout_rates = [layer.rate for layer in model.layers if isinstance(layer, tf.keras.layers.Dropout)]
+    # The frozen layers are carried over below, layer by layer
+    new_model = vgg16_unet(image_size=image_size, n_max_filters=n_max_filters, freeze="none",
+                           context_mode=model.output_shape[1] != image_size, num_classes=model.output_shape[-1],
+                           dropout=dropout_rates[0] if len(dropout_rates) > 0 else 0.0, input_channels=1,
+                           weights=None)
+    new_layers = [layer for layer in new_model.layers if len(layer.get_weights()) > 0]
+    if len(old_layers) != len(new_layers):
+        raise ValueError("The model does not have the vgg16_unet architecture")
+
+    for i, (old_layer, new_layer) in enumerate(zip(old_layers, new_layers)):
+        layer_weights = old_layer.get_weights()
+        if i == 0:
+            # Fold the color channels of the first conv layer
+            layer_weights[0] = np.sum(layer_weights[0], axis=2, keepdims=True)
+        new_layer.set_weights(layer_weights)
+        new_layer.trainable = old_layer.trainable
+    return new_model
+
+
 def run(train_data_folder_path, val_data_folder_path, model_name="vgg16", freeze="all", image_augmentation=True,
         context_mode=False, run_path="/home/kitkat/PycharmProjects/river-segmentation/runs", replace_unknown=True,
-        dropout=0):
+        dropout=0, input_channels=3, data_dtype="float32", epochs=100, patience=10):
     """
     Trains a CNN Unet model and saves the best model to file. If using large datasets consider using the run_from_dir
     function instead to decrease RAM usage.
@@ -125,11 +192,18 @@ def run(train_data_folder_path, val_data_folder_path, model_name="vgg16", freeze
     :param model_name: The name of the model. Supported models are: vgg16
     :param freeze: Determine how many blocks in the encoder that are frozen during training.
     Should be all, first, 1, 2, 3, 4, 5 or none
-    :param image_augmentation: Determines if image augmentation are used on the training data.
+    :param image_augmentation: Determines if image augmentation are used on the training data. Each batch is flipped
+    and rotated by a random transform.
     :param context_mode: Determines if image context are included on the training data. Recommended set to False
     :param run_path: Folder where the run information and model will be saved.
     :param replace_unknown: When True the unknown class in the training date will be replaced using closest neighbor.
     :param dropout: Drop rate, [0.0, 1)
+    :param input_channels: The number of input channels of the model. 3 for fake colors, 1 for gray scale.
+    :param data_dtype: The dtype of the images given to the model, float32 or float16. float16 halves the memory used
+    by the validation set.
+    :param epochs: The max number of epochs. With image augmentation an epoch uses every image 12 times (with random
+    transforms), the size of the training set augmented by model_utils.image_augmentation.
+    :param patience: The number of epochs without improvement of the validation loss before the training stops.
     :return: Writes model to the run folder, nothing is returned.
     """
     tf.keras.backend.clear_session()
@@ -144,31 +218,27 @@ def run(train_data_folder_path, val_data_folder_path, model_name="vgg16", freeze
 
     # Load data
     # Training data
-    train = model_utils.load_dataset(train_data_folder_path)
+    train_X, train_y = model_utils.load_dataset_arrays(train_data_folder_path)
     print(f"Loading the training data took {time.time() - start_time} seconds")
-    train_X, train_y = model_utils.convert_training_images_to_numpy_arrays(train)
-    print(f"Converting to a numpy array took {time.time() - start_time} seconds")
-    del train
     if replace_unknown:
         train_y = model_utils.replace_class(train_y, class_id=5)
-    train_X = model_utils.fake_colors(train_X)
-    if image_augmentation:
-        train_X = model_utils.image_augmentation(train_X)
-        train_y = model_utils.image_augmentation(train_y)
-    print(f"Converting image augmentation and color faking took {time.time() - start_time} seconds")
+    # The images are normalized, given fake colors and augmented one batch at a time
+    transforms = model_utils.DIHEDRAL_TRANSFORMS if image_augmentation else [(None, 0)]
+    # An epoch has as many images as the augmented training set had, so the epochs and patience mean the same as before
+    repeats = len(model_utils.AUGMENTATION_TRANSFORMS) if image_augmentation else 1
+    train_sequence = input_pipeline.AugmentedSequence(train_X, train_y, batch_size=4, n_channels=input_channels,
+                                                      dtype=data_dtype, transforms=transforms, repeats=repeats)
 
     # Validation data
-    val = model_utils.load_dataset(val_data_folder_path)
-    val_X, val_y = model_utils.convert_training_images_to_numpy_arrays(val)
-    del val
+    val_X, val_y = model_utils.load_dataset_arrays(val_data_folder_path)
+    val_X, val_y = model_utils.convert_to_model_arrays(val_X, val_y, dtype=data_dtype, n_channels=input_channels)
     if replace_unknown:
-        model_utils.replace_class(val_y, class_id=5)
-    val_X = model_utils.fake_colors(val_X)
+        val_y = model_utils.replace_class(val_y, class_id=5)
 
     # Load and compile model
     if model_name.lower() == "vgg16":
         model = vgg16_unet(freeze=freeze, context_mode=context_mode, num_classes=5 if replace_unknown else 6,
-                           dropout=dropout)
+                           dropout=dropout, input_channels=input_channels)
     else:
         model = None
     opt = tf.keras.optimizers.Adam(learning_rate=0.0001)
@@ -176,7 +246,7 @@ def run(train_data_folder_path, val_data_folder_path, model_name="vgg16", freeze
 
     # Define callbacks
     callbacks = []
-    callbacks.append(tf.keras.callbacks.EarlyStopping(patience=10, monitor="val_loss"))
+    callbacks.append(tf.keras.callbacks.EarlyStopping(patience=patience, monitor="val_loss"))
 
     checkpoint = tf.keras.callbacks.ModelCheckpoint(os.path.join(run_path, "model.hdf5"),
                                                     monitor="val_loss", save_best_only=True)
@@ -189,7 +259,7 @@ def run(train_data_folder_path, val_data_folder_path, model_name="vgg16", freeze
     callbacks.append(csv_logger)
 
     # Train the model
-    model.fit(train_X, train_y, batch_size=4, epochs=100, validation_data=(val_X, val_y), callbacks=callbacks)
+    model.fit(train_sequence, epochs=epochs, validation_data=(val_X, val_y), callbacks=callbacks)
 
     # Print and save confusion matrix
     print("Confusion matrix on the validation data")
@@ -206,7 +276,8 @@ def run(train_data_folder_path, val_data_folder_path, model_name="vgg16", freeze
 
 
 def run_from_dir(train_data_folder_path, val_data_folder_path, model_name="vgg16", freeze="all",
-                 run_path="/home/kitkat/PycharmProjects/river-segmentation/runs", batch_size=1, dropout=0):
+                 run_path="/home/kitkat/PycharmProjects/river-segmentation/runs", batch_size=1, dropout=0,
+                 input_channels=3, cache=False, shuffle_buffer=256):
     """
         Trains a CNN Unet model and saves the best model to file. Uses training images from disk instead of loading
         everything into RAM.
@@ -218,6 +289,10 @@ def run_from_dir(train_data_folder_path, val_data_folder_path, model_name="vgg16
         Should be all, first, 1, 2, 3, 4, 5 or none
         :param run_path: Folder where the run information and model will be saved.
         :param dropout: Drop rate, [0.0, 1)
+        :param input_channels: The number of input channels of the model. 3 for fake colors, 1 for gray scale.
+        :param cache: Cache the decoded training images, see input_pipeline.make_dataset. True for memory or a file
+        path prefix for a cache on disk.
+        :param shuffle_buffer: The number of decoded images in the shuffle buffer when caching.
         :return: Writes model to the run folder, nothing is returned.
         """
 
@@ -230,26 +305,21 @@ def run_from_dir(train_data_folder_path, val_data_folder_path, model_name="vgg16
     run_path = os.path.join(run_path, f"{date}_{run_name}".replace(" ", "_"))
     os.makedirs(run_path, exist_ok=True)
 
-    # Setup data generators
-    image_datagen = tf.keras.preprocessing.image.ImageDataGenerator(preprocessing_function=lambda x: x/(2**8 -1))
-    mask_datagen = tf.keras.preprocessing.image.ImageDataGenerator()
-
-    image_generator = image_datagen.flow_from_directory(os.path.join(train_data_folder_path, "images"),
-                                                        class_mode=None, target_size=(512, 512), seed=1, batch_size=batch_size)
-    mask_generator = mask_datagen.flow_from_directory(os.path.join(train_data_folder_path, "labels"),
-                                                      class_mode=None, target_size=(512, 512), seed=1, batch_size=batch_size,
-                                                      color_mode="grayscale")
-    train_generator = (pair for pair in zip(image_generator, mask_generator))
+    # Read, decode and prepare the training pairs in parallel with the training
+    train_dataset, steps_per_epoch = input_pipeline.make_dataset(train_data_folder_path, batch_size=batch_size,
+                                                                 n_channels=input_channels, cache=cache,
+                                                                 shuffle_buffer=shuffle_buffer)
+    print(f"{steps_per_epoch} training steps per epoch")
 
     # Validation data
     val = model_utils.load_dataset(val_data_folder_path)
-    val_X, val_y = model_utils.convert_training_images_to_numpy_arrays(val)
-    val_X = model_utils.fake_colors(val_X)
+    val_X, val_y = model_utils.convert_training_images_to_numpy_arrays(val, n_channels=input_channels)
     val_y = model_utils.replace_class(val_y, class_id=5)
 
     # Load and compile model
     if model_name.lower() == "vgg16":
-        model = vgg16_unet(freeze=freeze, context_mode=False, num_classes=5, dropout=dropout)
+        model = vgg16_unet(freeze=freeze, context_mode=False, num_classes=5, dropout=dropout,
+                           input_channels=input_channels)
     else:
         model = None
     opt = tf.keras.optimizers.Adam(learning_rate=0.0001)
@@ -270,7 +340,8 @@ def run_from_dir(train_data_folder_path, val_data_folder_path, model_name="vgg16
     callbacks.append(csv_logger)
 
     # Train the model
-    model.fit_generator(train_generator, epochs=100, validation_data=(val_X, val_y), steps_per_epoch=int(np.ceil(57648/batch_size)), callbacks=callbacks, verbose=2)
+    model.fit(train_dataset, epochs=100, validation_data=(val_X, val_y), steps_per_epoch=steps_per_epoch,
+              callbacks=callbacks, verbose=2)
 
     # Print and save confusion matrix
     print("Confusion matrix on the validation data")
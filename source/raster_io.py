@@ -0,0 +1,267 @@
+import os
+import gdal
+
+"""
+Windowed reading and writing of big rasters. Only the windows that are needed are read from (or written to) disk, so
+the memory used per image is bounded by a few tiles instead of the size of the whole image.
+Also defines the profiles (data type, tiling, compression and overviews) that rasters are written with.
+"""
+
+OVERVIEW_LEVELS = [2, 4, 8, 16]
+# Added to the output path of the uncompressed file that a WindowedRasterWriter writes to before the final copy
+TEMP_SUFFIX = ".tmp.tif"
+
+
+class RasterProfile:
+    """
+    How a raster is stored: data type, internal tiling, compression and overviews.
+    """
+
+    def __init__(self, data_type=gdal.GDT_Byte, compress="DEFLATE", predictor=2, tiled=True, block_size=512,
+                 overviews=False, overview_resampling="NEAREST"):
+        """
+        :param data_type: The gdal data type. Byte is enough for class ids and 8 bit images.
+        :param compress: The compression, e.g. DEFLATE, LZW or ZSTD. None for no compression.
+        :param predictor: The compression predictor (2 is horizontal differencing). None for no predictor.
+        :param tiled: Store the raster in square blocks instead of strips.
+        :param block_size: The size of the blocks in pixels when tiled.
+        :param overviews: Add internal overviews in the cloud optimized GeoTIFF layout (overviews before the data).
+        :param overview_resampling: The resampling used for the overviews. NEAREST keeps valid class ids.
+        """
+        self.data_type = data_type
+        self.compress = compress
+        self.predictor = predictor
+        self.tiled = tiled
+        self.block_size = block_size
+        self.overviews = overviews
+        self.overview_resampling = overview_resampling
+
+    def creation_options(self):
+        """
+        :return: A list with the GTiff creation options of the profile.
+        """
+        options = []
+        if self.tiled:
+            options += ["TILED=YES", f"BLOCKXSIZE={self.block_size}", f"BLOCKYSIZE={self.block_size}"]
+        if self.compress is not None:
+            options.append(f"COMPRESS={self.compress}")
+            if self.predictor is not None:
+                options.append(f"PREDICTOR={self.predictor}")
+        return options
+
+    def is_staged(self):
+        """
+        :return: True if windowed writes should go to an uncompressed temporary file that is copied into this profile
+        when it is complete. Compressed blocks that are written more than once (e.g. by windows that are not aligned to
+        the blocks) are appended to the file again instead of replaced, and overviews must come before the data.
+        """
+        return self.compress is not None or self.overviews
+
+    def staging_profile(self):
+        """
+        :return: The profile of the temporary file, uncompressed strips of the same data type.
+        """
+        return RasterProfile(data_type=self.data_type, compress=None, predictor=None, tiled=False)
+
+
+# Uncompressed Int16 strips, as the rasters were written before the profiles
+LEGACY_PROFILE = RasterProfile(data_type=gdal.GDT_Int16, compress=None, predictor=None, tiled=False)
+# Byte, 512x512 tiles and DEFLATE compression
+DEFAULT_PROFILE = RasterProfile()
+# The default profile with overviews in the cloud optimized GeoTIFF layout
+COG_PROFILE = RasterProfile(overviews=True)
+# The profiles by name, e.g. for command line options
+PROFILES = {"default": DEFAULT_PROFILE, "cog": COG_PROFILE, "legacy": LEGACY_PROFILE}
+
+
+def _copy_to_profile(source_ds, output_filepath, profile):
+    # Copy the complete raster into the profile, so every block is compressed once
+    options = profile.creation_options()
+    if profile.overviews:
+        # Build the overviews and copy them before the data, in the cloud optimized GeoTIFF layout
+        source_ds.BuildOverviews(profile.overview_resampling, OVERVIEW_LEVELS)
+        options.append("COPY_SRC_OVERVIEWS=YES")
+    try:
+        output_ds = gdal.GetDriverByName("GTiff").CreateCopy(output_filepath, source_ds, options=options)
+        if output_ds is None:
+            raise Exception(f"Could not copy the raster to {output_filepath}")
+        output_ds = None  # Flush and close the copy, the gdal way
+    except Exception:
+        # A partial copy is not a valid raster
+        if os.path.isfile(output_filepath):
+            os.remove(output_filepath)
+        raise
+
+
+def write_raster(output_filepath, array, geo_transform, projection, profile=DEFAULT_PROFILE):
+    """
+    Writes the array to a GeoTIFF.
+    :param output_filepath: The output file.
+    :param array: A numpy array with shape (height, width) or (height, width, bands).
+    :param geo_transform: A list defining the geo transform. See gdal doc for more info
+    :param projection: The Geo projection. See gdal doc for more info.
+    :param profile: The RasterProfile of the output.
+    :return: Nothing
+    """
+    bands = array.shape[-1] if len(array.shape) > 2 else 1
+    if profile.overviews:
+        raster = gdal.GetDriverByName("MEM").Create("", array.shape[1], array.shape[0], bands, profile.data_type)
+    else:
+        raster = gdal.GetDriverByName("GTiff").Create(output_filepath, array.shape[1], array.shape[0], bands,
+                                                      profile.data_type, options=profile.creation_options())
+    raster.SetGeoTransform(geo_transform)
+    raster.SetProjection(projection)
+    # Write multiple bands
+    if len(array.shape) > 2:
+        for band in range(array.shape[-1]):
+            raster.GetRasterBand(band + 1).WriteArray(array[:, :, band])
+    # Write single band
+    else:
+        raster.GetRasterBand(1).WriteArray(array)
+    if profile.overviews:
+        _copy_to_profile(raster, output_filepath, profile)
+    raster = None
+
+
+def tile_offsets(length, tile_size, stride=None):
+    """
+    The offsets of the tiles along one axis of an image. The last tile is shifted back to end at the edge of the image,
+    so the whole image is covered even if the length is not a multiple of the stride. This is the same tiling as
+    data_processing.divide_image uses without overlap.
+    :param length: The length of the axis in pixels.
+    :param tile_size: The size of the tiles in pixels.
+    :param stride: The distance between the tiles in pixels. Defaults to the tile size (no overlap).
+    :return: A list with the offsets in pixels.
+    """
+    if stride is None:
+        stride = tile_size
+    if length < tile_size:
+        raise ValueError(f"The image ({length} pixels) is smaller than the tile size ({tile_size} pixels)")
+    offsets = list(range(0, length - tile_size, stride))
+    offsets.append(length - tile_size)
+    return offsets
+
+
+def iterate_tiles(dataset, tile_size=512, stride=None, band_index=1):
+    """
+    Reads the tiles of a raster one window at a time, row by row. The reads follow the block layout of the file: for
+    striped files (blocks spanning the whole width) one band of rows is read per tile row, for tiled files each tile
+    window is read on its own.
+    :param dataset: An open gdal dataset.
+    :param tile_size: The size of the tiles in pixels.
+    :param stride: The distance between the tiles in pixels. Defaults to the tile size (no overlap).
+    :param band_index: The raster band to read.
+    :return: A generator of (north_offset, east_offset, tile) tuples where tile is a numpy array with shape
+    (tile_size, tile_size).
+    """
+    band = dataset.GetRasterBand(band_index)
+    block_x_size, _ = band.GetBlockSize()
+    x_size = dataset.RasterXSize
+    north_offsets = tile_offsets(dataset.RasterYSize, tile_size, stride)
+    east_offsets = tile_offsets(x_size, tile_size, stride)
+    read_row_bands = block_x_size >= x_size
+
+    for north_offset in north_offsets:
+        if read_row_bands:
+            # Every block covers the whole width, so reading the full row band touches the same blocks as the tiles
+            row_band = band.ReadAsArray(0, north_offset, x_size, tile_size)
+            for east_offset in east_offsets:
+                yield north_offset, east_offset, row_band[:, east_offset:east_offset + tile_size]
+        else:
+            for east_offset in east_offsets:
+                yield north_offset, east_offset, band.ReadAsArray(east_offset, north_offset, tile_size, tile_size)
+
+
+class WindowedRasterWriter:
+    """
+    Writes windows (e.g. predicted tiles) straight into a single band raster that is open in update mode. For
+    compressed profiles and profiles with overviews the windows go to an uncompressed temporary file, which is copied
+    into the profile when the writer is closed (see RasterProfile.is_staged).
+    """
+
+    def __init__(self, dataset, output_filepath=None, profile=None):
+        """
+        :param dataset: A gdal dataset opened in update mode.
+        :param output_filepath: Only needed for staged profiles. The dataset is then a temporary file that is copied to
+        this path when the writer is closed.
+        :param profile: The RasterProfile of the output, only needed for staged profiles.
+        """
+        self.dataset = dataset
+        self.band = dataset.GetRasterBand(1)
+        self.output_filepath = output_filepath
+        self.profile = profile
+
+    @classmethod
+    def create_like(cls, output_filepath, source_dataset, profile=DEFAULT_PROFILE):
+        """
+        Creates a new GeoTIFF with the same size, geo transform and projection as the source dataset.
+        :param output_filepath: The path of the new raster.
+        :param source_dataset: An open gdal dataset to copy the georeferencing from.
+        :param profile: The RasterProfile of the new raster.
+        :return: A WindowedRasterWriter for the new raster.
+        """
+        driver = gdal.GetDriverByName("GTiff")
+        if profile.is_staged():
+            path = output_filepath + TEMP_SUFFIX
+            options = profile.staging_profile().creation_options()
+        else:
+            path = output_filepath
+            options = profile.creation_options()
+        dataset = driver.Create(path, source_dataset.RasterXSize, source_dataset.RasterYSize,
+                                1, profile.data_type, options=options)
+        dataset.SetGeoTransform(source_dataset.GetGeoTransform())
+        dataset.SetProjection(source_dataset.GetProjection())
+        if profile.is_staged():
+            return cls(dataset, output_filepath=output_filepath, profile=profile)
+        return cls(dataset)
+
+    @classmethod
+    def open(cls, output_filepath):
+        """
+        Opens an existing raster in update mode.
+        :param output_filepath: The path to the raster.
+        :return: A WindowedRasterWriter for the raster.
+        """
+        return cls(gdal.Open(output_filepath, gdal.GA_Update))
+
+    def write(self, array, north_offset, east_offset):
+        """
+        Writes the array into the raster with its top left corner at the offsets.
+        :param array: A numpy array with shape (height, width).
+        :param north_offset: The offset in pixels from the most north point.
+        :param east_offset: The offset in pixels from the most east point.
+        :return: Nothing
+        """
+        self.band.WriteArray(array, east_offset, north_offset)
+
+    def close(self):
+        """
+        Flushes the raster to disk and closes it, the gdal way. If that fails the writer is aborted.
+        :return: Nothing
+        """
+        self.band = None
+        try:
+            self.dataset.FlushCache()
+            if self.profile is not None:
+                _copy_to_profile(self.dataset, self.output_filepath, self.profile)
+        except Exception:
+            self.abort()
+            raise
+        path = self.dataset.GetDescription()
+        self.dataset = None
+        if self.profile is not None:
+            # The temporary file
+            os.remove(path)
+
+    def abort(self):
+        """
+        Closes the raster without finishing it and removes the file that was written to, e.g. after an error while
+        writing. For staged profiles that is the temporary file, the output is only written when the writer is closed,
+        so an output from an earlier run is kept.
+        :return: Nothing
+        """
+        self.band = None
+        path = self.dataset.GetDescription()
+        self.dataset = None
+        if os.path.isfile(path):
+            os.remove(path)
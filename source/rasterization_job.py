@@ -0,0 +1,124 @@
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+import gdal
+import data_processing
+
+"""
+Rasterizes the label polygons for many images with a pool of worker processes. The polygons (with their spatial
+indexes) are loaded once in every worker. Each label raster is written to a temporary file and renamed when it is
+complete, and the finished images (and the failures with their errors) are recorded in a manifest in the destination
+folder. A job that is interrupted can be run again and continues with the images that are not finished.
+Usage: python rasterization_job.py image_folder label_folder destination_folder [n_workers]
+"""
+
+MANIFEST_NAME = "manifest.jsonl"
+
+_worker_polygons = None
+
+
+def _init_worker(label_folder_path):
+    global _worker_polygons
+    # Raise gdal errors as exceptions, so they are recorded as failures instead of coming back as None datasets
+    gdal.UseExceptions()
+    _worker_polygons = data_processing.load_polygons(label_folder_path)
+
+
+def _rasterize_in_worker(task):
+    image_path, destination_path, single_pass = task
+    start_time = time.time()
+    temp_path = destination_path + ".tmp.tif"
+    try:
+        # A temporary file left by an interrupted job
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        data_processing.create_raster_labels(image_path, _worker_polygons, temp_path, single_pass=single_pass)
+        if os.path.isfile(temp_path):
+            os.replace(temp_path, destination_path)
+            output_path = destination_path
+        else:
+            # No polygons overlap the image
+            output_path = None
+    except Exception as e:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        return image_path, None, f"{type(e).__name__}: {e}", time.time() - start_time
+    return image_path, output_path, None, time.time() - start_time
+
+
+def read_manifest(manifest_path):
+    """
+    :param manifest_path: The path to the manifest (.jsonl file).
+    :return: A dict with image path -> manifest entry of the finished images. The images that failed are left out.
+    """
+    entries = {}
+    if not os.path.isfile(manifest_path):
+        return entries
+    with open(manifest_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut off by an interruption
+                continue
+            if entry.get("error") is None:
+                entries[entry["image_path"]] = entry
+    return entries
+
+
+def run_job(image_paths, label_folder_path, destination_folder, n_workers=None, single_pass=True,
+            name_prefix="label"):
+    """
+    Creates the label rasters of the images, see data_processing.create_raster_labels.
+    :param image_paths: A list of paths to the images (.tif) that define the areas of the label rasters.
+    :param label_folder_path: The folder with the label shapefiles, one per class.
+    :param destination_folder: The folder where the label rasters and the manifest are written.
+    :param n_workers: The number of worker processes. Defaults to the number of cores.
+    :param single_pass: Rasterize all the classes in one pass, see data_processing.create_raster_labels.
+    :param name_prefix: Added in front of the image names to make the names of the label rasters.
+    :return: A list of (image path, error message) tuples for the images that failed.
+    """
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    os.makedirs(destination_folder, exist_ok=True)
+    manifest_path = os.path.join(destination_folder, MANIFEST_NAME)
+    finished = read_manifest(manifest_path)
+    tasks = [(path, os.path.join(destination_folder, name_prefix + os.path.split(path)[-1]), single_pass)
+             for path in image_paths if path not in finished]
+    print(f"{len(image_paths) - len(tasks)} of {len(image_paths)} images are finished already")
+    if len(tasks) == 0:
+        return []
+
+    # Build (or check) the spatial indexes once, so the workers only have to load them
+    data_processing.load_polygons(label_folder_path)
+
+    failures = []
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(n_workers, initializer=_init_worker, initargs=(label_folder_path,)) as pool, \
+            open(manifest_path, "a") as manifest:
+        for i, (path, output_path, error, seconds) in enumerate(pool.imap_unordered(_rasterize_in_worker, tasks,
+                                                                                    chunksize=1)):
+            if error is not None:
+                print(f"[{i + 1}/{len(tasks)}] Failed to rasterize {path}: {error}")
+                failures.append((path, error))
+            else:
+                print(f"[{i + 1}/{len(tasks)}] Rasterized {path} in {seconds:.1f} seconds")
+            # Failures are recorded with their error, they are not finished and are retried by the next run
+            manifest.write(json.dumps({"image_path": path, "output_path": output_path, "seconds": seconds,
+                                       "finished": time.strftime("%Y-%m-%d %H:%M:%S"), "error": error}) + "\n")
+            manifest.flush()
+            os.fsync(manifest.fileno())
+    if len(failures) > 0:
+        print(f"{len(failures)} of {len(tasks)} images failed, run the job again to retry them")
+    return failures
+
+
+if __name__ == '__main__':
+    image_folder = sys.argv[1]
+    label_folder = sys.argv[2]
+    destination_folder = sys.argv[3]
+    n_workers = int(sys.argv[4]) if len(sys.argv) >= 5 else None
+    run_job(glob.glob(os.path.join(image_folder, "*.tif")), label_folder, destination_folder, n_workers=n_workers)
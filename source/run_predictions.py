@@ -1,57 +1,191 @@
 import model_utils
-import data_processing
+import prediction_pipeline
+import raster_io
+import sliding_window
+import argparse
+import copy
 import glob
+import multiprocessing
 import os
-import sys
-import numpy as np
+import time
 import gdal
+import tensorflow as tf
 
 """
-This script should be used to make predictions on a set of big images (6000x8000 pixels). Image of other sizes should 
-also work but this has not been tested. A folder of images must be provided as well as a trained model. 
+This script should be used to make predictions on a set of big images (6000x8000 pixels). Image of other sizes should
+also work but this has not been tested. A folder of images must be provided as well as a trained model.
 The predictions will be written to a output folder. The output images will be in
-the big image format as geo referenced tiff files. 
+the big image format as geo referenced tiff files.
 """
 
+TILE_SIZE = 512
 
-def run(model_path, input_folder, output_folder, intensity_correction=0.0):
+
+def predict_big_image(model, big_image_path, output_path, batch_size=8, intensity_correction=0.0, stride=None,
+                      tta=None, profile=raster_io.DEFAULT_PROFILE):
+    """
+    Predicts on a big image one window at a time and writes each predicted window straight to the output raster, so the
+    big image is never loaded into memory as a whole.
+    :param model: A keras model.
+    :param big_image_path: The path to the big image (.tif).
+    :param output_path: The path of the output raster.
+    :param batch_size: The number of tiles in each call to the model.
+    :param intensity_correction: Added to the image to adjust for differing light levels.
+    :param stride: The distance in pixels between overlapping tiles. The softmax outputs of overlapping tiles are
+    blended with a gaussian window. When None the tiles don't overlap.
+    :param tta: Test time augmentation, see model_utils.predict_tiles. None for no test time augmentation.
+    :param profile: The raster_io.RasterProfile (data type, tiling, compression and overviews) of the output.
+    :return: Nothing
+    """
+    if stride is not None and not 0 < stride <= TILE_SIZE:
+        raise ValueError(f"The stride must be between 1 and {TILE_SIZE}, it was {stride}")
+    big_image_ds = gdal.Open(big_image_path)
+    writer = raster_io.WindowedRasterWriter.create_like(output_path, big_image_ds, profile=profile)
+    if stride is not None:
+        writer = sliding_window.BlendingRasterWriter(writer, big_image_ds.RasterXSize, big_image_ds.RasterYSize,
+                                                     model.output_shape[-1], tile_size=TILE_SIZE)
+
+    def predict_and_write(tiles, offsets):
+        predictions = model_utils.predict_tiles(model, tiles, batch_size=batch_size,
+                                                intensity_correction=intensity_correction,
+                                                return_probabilities=stride is not None, tta=tta)
+        for prediction, (north_offset, east_offset) in zip(predictions, offsets):
+            if stride is not None:
+                writer.add(prediction, north_offset, east_offset)
+            else:
+                writer.write(prediction, north_offset, east_offset)
+
+    tiles = []
+    offsets = []
+    try:
+        for north_offset, east_offset, tile in raster_io.iterate_tiles(big_image_ds, tile_size=TILE_SIZE,
+                                                                       stride=stride):
+            tiles.append(tile)
+            offsets.append((north_offset, east_offset))
+            if len(tiles) == batch_size:
+                predict_and_write(tiles, offsets)
+                tiles = []
+                offsets = []
+        if len(tiles) > 0:
+            predict_and_write(tiles, offsets)
+    except Exception:
+        # Don't leave a partial prediction (or temporary file) behind
+        writer.abort()
+        raise
+
+    writer.close()
+    big_image_ds = None  # Close the image the gdal way
+
+
+# The model of a worker process in run_parallel, loaded once when the worker starts
+_worker_model = None
+
+
+def _init_worker(model_path, intra_op_threads):
+    global _worker_model
+    # Limit the thread pools of tensorflow so the workers don't oversubscribe the cores
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    _worker_model = model_utils.load_model(model_path)
+
+
+def _predict_in_worker(task):
+    big_image_path, output_path, batch_size, intensity_correction, stride, tta, profile = task
+    start_time = time.time()
+    try:
+        predict_big_image(_worker_model, big_image_path, output_path, batch_size=batch_size,
+                          intensity_correction=intensity_correction, stride=stride, tta=tta, profile=profile)
+    except Exception as e:
+        # The writer removes what it wrote when it fails (see WindowedRasterWriter.abort), this only catches a temporary
+        # file left behind if that cleanup failed. The output path may hold a good prediction from an earlier run
+        if os.path.isfile(output_path + raster_io.TEMP_SUFFIX):
+            os.remove(output_path + raster_io.TEMP_SUFFIX)
+        return big_image_path, f"{type(e).__name__}: {e}", time.time() - start_time
+    return big_image_path, None, time.time() - start_time
+
+
+def run_parallel(model_path, input_folder, output_folder, n_workers, threads_per_worker=None,
+                 intensity_correction=0.0, batch_size=8, stride=None, tta=None, profile=raster_io.DEFAULT_PROFILE):
+    """
+    Makes predictions on the big images with a pool of worker processes. Each worker loads the model once and then takes
+    images from a shared queue. An image that fails is reported and skipped, the other images are not affected.
+    :param model_path: The path to the model (.hdf5 file).
+    :param input_folder: The folder with the big images (.tif files).
+    :param output_folder: The folder where the predictions will be written.
+    :param n_workers: The number of worker processes.
+    :param threads_per_worker: The number of intra op threads of tensorflow in each worker. Defaults to the number of
+    cores divided by the number of workers.
+    :param intensity_correction: Added to the images to adjust for differing light levels.
+    :param batch_size: The number of tiles in each call to the model.
+    :param stride: The distance in pixels between overlapping tiles, see predict_big_image.
+    :param tta: Test time augmentation, see model_utils.predict_tiles.
+    :param profile: The raster_io.RasterProfile of the outputs.
+    :return: A list of (image path, error message) tuples for the images that failed.
+    """
+    if threads_per_worker is None:
+        threads_per_worker = max(1, multiprocessing.cpu_count() // n_workers)
+    big_image_paths = glob.glob(os.path.join(input_folder, "*.tif"))
+    tasks = [(path, os.path.join(output_folder, os.path.split(path)[-1]), batch_size, intensity_correction, stride,
+              tta, profile) for path in big_image_paths]
+
+    failures = []
+    # Spawn fresh processes, tensorflow does not work well in forked processes
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(n_workers, initializer=_init_worker, initargs=(model_path, threads_per_worker)) as pool:
+        for i, (path, error, seconds) in enumerate(pool.imap_unordered(_predict_in_worker, tasks, chunksize=1)):
+            if error is None:
+                print(f"[{i + 1}/{len(tasks)}] Predicted {path} in {seconds:.1f} seconds")
+            else:
+                print(f"[{i + 1}/{len(tasks)}] Failed to predict {path}: {error}")
+                failures.append((path, error))
+    if len(failures) > 0:
+        print(f"{len(failures)} of {len(tasks)} images failed")
+    return failures
+
+
+def run(model_path, input_folder, output_folder, intensity_correction=0.0, batch_size=8, stride=None, tta=None,
+        profile=raster_io.DEFAULT_PROFILE):
     model = model_utils.load_model(model_path)
     big_image_paths = glob.glob(os.path.join(input_folder, "*.tif"))
-    for big_image_path in big_image_paths:
-        images = data_processing.divide_image(big_image_path, big_image_path, image_size=512, do_crop=False,
-                                              do_overlap=False)
-        # Make predictions
-        for image in images:
-            data = model_utils.convert_training_images_to_numpy_arrays([image])[0]
-            data += intensity_correction / (2**8 - 1)
-            data = model_utils.fake_colors(data)
-
-            prediction = model.predict(data)
-            prediction = np.argmax(prediction, axis=-1)
-            prediction = np.squeeze(prediction)
-            image.labels = prediction
-
-        big_image_ds = gdal.Open(big_image_path)
-        geo_transform = big_image_ds.GetGeoTransform()
-        projection = big_image_ds.GetProjection()
-        big_image_shape = (big_image_ds.RasterYSize, big_image_ds.RasterXSize)
-        big_image_ds = None  # Close the image the gdal way
-
-        big_image_array = data_processing.reassemble_big_image(images, small_image_size=512,
-                                                               big_image_shape=big_image_shape)
-        big_image = data_processing.TrainingImage(big_image_array, big_image_array, geo_transform,
-                                                  projection=projection, name=os.path.split(big_image_path)[-1])
-        big_image.write_labels_to_raster(os.path.join(output_folder, big_image.name))
+    # Read, predict and write in parallel stages
+    prediction_pipeline.run_pipeline(model, big_image_paths, output_folder, batch_size=batch_size,
+                                     intensity_correction=intensity_correction, stride=stride, tta=tta,
+                                     profile=profile)
 
 
 if __name__ == '__main__':
     # Get args
-    model_path = sys.argv[1]
-    input_folder = sys.argv[2]
-    output_folder = sys.argv[3]
-    if len(sys.argv) >= 5:
-        intensity_correction = float(sys.argv[4])
-    else:
-        intensity_correction = 0.0
+    parser = argparse.ArgumentParser(description="Make predictions on a folder of big images.")
+    parser.add_argument("model_path", help="Path to the trained model (.hdf5 file)")
+    parser.add_argument("input_folder", help="Folder with the big images (.tif files)")
+    parser.add_argument("output_folder", help="Folder where the predictions will be written")
+    parser.add_argument("intensity_correction", nargs="?", type=float, default=0.0,
+                        help="Added to the images to adjust for differing light levels")
+    parser.add_argument("--batch_size", type=int, default=8, help="Number of tiles in each call to the model")
+    parser.add_argument("--stride", type=int, default=None,
+                        help="Predict on overlapping tiles this many pixels apart and blend the outputs")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes, each predicting on one image at a time")
+    parser.add_argument("--threads_per_worker", type=int, default=None,
+                        help="Number of tensorflow intra op threads in each worker process")
+    parser.add_argument("--tta", choices=["fast", "full"], default=None,
+                        help="Test time augmentation: average the predictions of the 8 unique (fast) or all 12 (full) "
+                             "rotations and flips of each tile")
+    parser.add_argument("--profile", choices=sorted(raster_io.PROFILES), default="default",
+                        help="How the output rasters are stored: default (Byte, tiled, DEFLATE), cog (default with "
+                             "overviews in the cloud optimized GeoTIFF layout) or legacy (uncompressed Int16 strips)")
+    parser.add_argument("--compress", choices=["DEFLATE", "LZW", "ZSTD", "NONE"], default=None,
+                        help="Compression of the output rasters, overrides the compression of the profile")
+    args = parser.parse_args()
+    profile = raster_io.PROFILES[args.profile]
+    if args.compress is not None:
+        profile = copy.copy(profile)
+        profile.compress = None if args.compress == "NONE" else args.compress
     # Predict and write to file
-    run(model_path, input_folder, output_folder, intensity_correction=intensity_correction)
\ No newline at end of file
+    if args.workers > 1:
+        run_parallel(args.model_path, args.input_folder, args.output_folder, args.workers,
+                     threads_per_worker=args.threads_per_worker, intensity_correction=args.intensity_correction,
+                     batch_size=args.batch_size, stride=args.stride, tta=args.tta, profile=profile)
+    else:
+        run(args.model_path, args.input_folder, args.output_folder, intensity_correction=args.intensity_correction,
+            batch_size=args.batch_size, stride=args.stride, tta=args.tta, profile=profile)
@@ -0,0 +1,85 @@
+import numpy as np
+
+"""
+Blending of overlapping tile predictions. The softmax outputs of the tiles are weighted with a window that is highest
+in the center of the tile, summed per pixel and argmaxed once. This removes the seams at the tile borders, where the
+model has the least context.
+"""
+
+
+def gaussian_window(tile_size=512, sigma_scale=1 / 8):
+    """
+    A 2D gaussian window that weights the center pixels of a tile more than the border pixels.
+    :param tile_size: The size of the tile in pixels.
+    :param sigma_scale: The standard deviation of the gaussian relative to the tile size.
+    :return: A float32 numpy array with shape (tile_size, tile_size) with 1 at the center.
+    """
+    center = (tile_size - 1) / 2
+    sigma = tile_size * sigma_scale
+    line = np.exp(-((np.arange(tile_size) - center) ** 2) / (2 * sigma ** 2))
+    window = np.outer(line, line)
+    return (window / np.max(window)).astype(np.float32)
+
+
+class BlendingRasterWriter:
+    """
+    Accumulates weighted softmax outputs of overlapping tiles and writes the argmax to a raster. Only one band of
+    tile_size rows is kept in memory: when a tile from a new tile row is added, the rows above it will not get any more
+    contributions, so they are argmaxed and written.
+    """
+
+    def __init__(self, writer, x_size, y_size, num_classes, tile_size=512, window=None):
+        """
+        :param writer: A raster_io.WindowedRasterWriter for the output raster.
+        :param x_size: The width of the output raster in pixels.
+        :param y_size: The height of the output raster in pixels.
+        :param num_classes: The number of classes in the softmax output.
+        :param tile_size: The size of the tiles in pixels.
+        :param window: The weights of the pixels in a tile. Defaults to a gaussian window.
+        """
+        self.writer = writer
+        self.y_size = y_size
+        self.tile_size = tile_size
+        self.window = gaussian_window(tile_size) if window is None else window
+        self.scores = np.zeros((tile_size, x_size, num_classes), dtype=np.float32)
+        self.top = 0  # The raster row of the first row in scores
+
+    def add(self, probabilities, north_offset, east_offset):
+        """
+        Adds the weighted softmax output of a tile. Tiles must be added row by row, from north to south.
+        :param probabilities: A numpy array with shape (tile_size, tile_size, num_classes).
+        :param north_offset: The offset in pixels from the most north point.
+        :param east_offset: The offset in pixels from the most east point.
+        :return: Nothing
+        """
+        if north_offset < self.top:
+            raise ValueError(f"Tiles must be added from north to south, but row {north_offset} was added after row "
+                             f"{self.top} was written")
+        if north_offset - self.top > self.tile_size:
+            raise ValueError(f"The tile rows can not be more than {self.tile_size} pixels apart")
+        if north_offset > self.top:
+            self._flush(north_offset)
+        self.scores[:, east_offset:east_offset + self.tile_size] += probabilities * self.window[:, :, np.newaxis]
+
+    def _flush(self, until_row):
+        # Write the rows that are done and move the rest to the top of the buffer
+        n_rows = until_row - self.top
+        self.writer.write(np.argmax(self.scores[:n_rows], axis=-1).astype(np.uint8), self.top, 0)
+        self.scores[:self.tile_size - n_rows] = self.scores[n_rows:]
+        self.scores[self.tile_size - n_rows:] = 0
+        self.top = until_row
+
+    def close(self):
+        """
+        Writes the remaining rows and closes the output raster.
+        :return: Nothing
+        """
+        self._flush(self.y_size)
+        self.writer.close()
+
+    def abort(self):
+        """
+        Closes the output raster without writing the remaining rows, see raster_io.WindowedRasterWriter.abort.
+        :return: Nothing
+        """
+        self.writer.abort()
@@ -0,0 +1,204 @@
+import os
+import numpy as np
+from osgeo import ogr
+from osgeo import osr
+
+"""
+A spatial index for the label polygons, so the polygons intersecting a scene are found without testing every polygon.
+The envelopes of the polygons are packed into a static R-tree with the Sort-Tile-Recursive (STR) algorithm. A query
+walks the tree one level at a time and only the polygons whose envelopes overlap the query envelope get the exact
+(and expensive) Intersects test. The index can be saved next to the shapefile, so it is only built once.
+"""
+
+NODE_CAPACITY = 16
+EPSG = 25833
+INDEX_SUFFIX = ".index.npz"
+
+
+def _spatial_reference():
+    ref = osr.SpatialReference()
+    ref.ImportFromEPSG(EPSG)
+    return ref
+
+
+def load_shapefile(shapefile_path):
+    """
+    Loads the geometries in a shapefile.
+    :param shapefile_path: The path to the shapefile (.shp).
+    :return: A list with the gdal geometries.
+    """
+    driver = ogr.GetDriverByName("ESRI Shapefile")
+    ds = driver.Open(shapefile_path, 0)
+    if ds is None:
+        raise Exception(f"Could not open the shapefile {shapefile_path}")
+    layer = ds.GetLayer()
+    ref = _spatial_reference()
+    polys = []
+    for feature in layer:
+        geom = feature.GetGeometryRef().Clone()
+        geom.AssignSpatialReference(ref)
+        polys.append(geom)
+    ds = None
+    return polys
+
+
+def _envelopes_overlap(envelopes, envelope):
+    # Envelopes are (min_x, max_x, min_y, max_y) like ogr's GetEnvelope
+    return ((envelopes[:, 0] <= envelope[1]) & (envelopes[:, 1] >= envelope[0]) &
+            (envelopes[:, 2] <= envelope[3]) & (envelopes[:, 3] >= envelope[2]))
+
+
+def _str_order(envelopes, node_capacity):
+    # Sort-Tile-Recursive packing: sort by x into vertical slices, then by y within each slice
+    n = len(envelopes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    centers_x = (envelopes[:, 0] + envelopes[:, 1]) / 2
+    centers_y = (envelopes[:, 2] + envelopes[:, 3]) / 2
+    n_nodes = int(np.ceil(n / node_capacity))
+    slice_size = int(np.ceil(np.sqrt(n_nodes))) * node_capacity
+    order = np.argsort(centers_x, kind="stable")
+    for start in range(0, n, slice_size):
+        part = order[start:start + slice_size]
+        order[start:start + slice_size] = part[np.argsort(centers_y[part], kind="stable")]
+    return order
+
+
+def _build_levels(leaf_envelopes, node_capacity):
+    # Each node covers node_capacity consecutive entries of the level below, so only the bounds need to be stored
+    levels = [leaf_envelopes]
+    while len(levels[-1]) > node_capacity:
+        below = levels[-1]
+        starts = np.arange(0, len(below), node_capacity)
+        levels.append(np.stack([np.minimum.reduceat(below[:, 0], starts),
+                                np.maximum.reduceat(below[:, 1], starts),
+                                np.minimum.reduceat(below[:, 2], starts),
+                                np.maximum.reduceat(below[:, 3], starts)], axis=1))
+    return levels[::-1]
+
+
+class PolygonIndex:
+    """
+    A collection of polygons with an STR-tree over their envelopes. Iterating over it gives the polygons, so it can be
+    used where a list of polygons is expected.
+    """
+
+    def __init__(self, polygons=None, node_capacity=NODE_CAPACITY, _wkbs=None, _envelopes=None):
+        """
+        :param polygons: A list of gdal geometries.
+        :param node_capacity: The max number of children of a node in the tree.
+        """
+        self.node_capacity = node_capacity
+        if polygons is not None:
+            envelopes = np.array([poly.GetEnvelope() for poly in polygons], dtype=np.float64).reshape(-1, 4)
+            order = _str_order(envelopes, node_capacity)
+            self._polygons = [polygons[i] for i in order]
+            self._wkbs = None
+            self._envelopes = envelopes[order]
+        else:
+            # Loaded from file, the geometries are parsed the first time they are needed
+            self._polygons = [None] * len(_wkbs)
+            self._wkbs = _wkbs
+            self._envelopes = _envelopes
+        self._levels = _build_levels(self._envelopes, node_capacity)
+
+    def __len__(self):
+        return len(self._envelopes)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._polygon(i)
+
+    def _polygon(self, i):
+        if self._polygons[i] is None:
+            geom = ogr.CreateGeometryFromWkb(self._wkbs[i])
+            geom.AssignSpatialReference(_spatial_reference())
+            self._polygons[i] = geom
+        return self._polygons[i]
+
+    def candidates(self, envelope):
+        """
+        :param envelope: A (min_x, max_x, min_y, max_y) tuple, like the one from ogr's GetEnvelope.
+        :return: A numpy array with the indices of the polygons whose envelopes overlap the envelope.
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        top = self._levels[0]
+        nodes = np.flatnonzero(_envelopes_overlap(top, envelope))
+        for level in self._levels[1:]:
+            # The children of the overlapping nodes
+            children = (nodes[:, np.newaxis] * self.node_capacity + np.arange(self.node_capacity)).ravel()
+            children = children[children < len(level)]
+            nodes = children[_envelopes_overlap(level[children], envelope)]
+        return nodes
+
+    def query(self, geometry):
+        """
+        :param geometry: A gdal geometry, e.g. the bounding box of an image.
+        :return: A list with the polygons that intersect the geometry.
+        """
+        return [self._polygon(i) for i in self.candidates(geometry.GetEnvelope())
+                if self._polygon(i).Intersects(geometry)]
+
+    def intersects_any(self, geometry):
+        """
+        :param geometry: A gdal geometry.
+        :return: True if any of the polygons intersects the geometry.
+        """
+        return any(self._polygon(i).Intersects(geometry) for i in self.candidates(geometry.GetEnvelope()))
+
+    def save(self, index_path, source_path=None):
+        """
+        Writes the index to file.
+        :param index_path: The path of the index (.npz file).
+        :param source_path: The shapefile the polygons come from. Its size and modification time are stored, so the
+        index is rebuilt when the shapefile changes.
+        :return: Nothing
+        """
+        wkbs = [bytes(self._polygon(i).ExportToWkb()) for i in range(len(self))]
+        offsets = np.cumsum([0] + [len(wkb) for wkb in wkbs])
+        source_stat = np.array([os.path.getsize(source_path), os.path.getmtime(source_path)]
+                               if source_path is not None else [-1, -1], dtype=np.float64)
+        np.savez(index_path, envelopes=self._envelopes, wkb=np.frombuffer(b"".join(wkbs), dtype=np.uint8),
+                 offsets=offsets, node_capacity=self.node_capacity, source_stat=source_stat)
+
+    @classmethod
+    def load(cls, index_path, source_path=None):
+        """
+        Reads an index written by save.
+        :param index_path: The path to the index (.npz file).
+        :param source_path: The shapefile the polygons come from. If given, None is returned when the shapefile has
+        changed since the index was written.
+        :return: A PolygonIndex, or None if the index is out of date.
+        """
+        with np.load(index_path) as data:
+            if source_path is not None:
+                stat = [os.path.getsize(source_path), os.path.getmtime(source_path)]
+                if not np.array_equal(data["source_stat"], np.array(stat, dtype=np.float64)):
+                    return None
+            wkb = data["wkb"].tobytes()
+            offsets = data["offsets"]
+            wkbs = [wkb[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+            return cls(node_capacity=int(data["node_capacity"]), _wkbs=wkbs, _envelopes=data["envelopes"])
+
+
+def load_index(shapefile_path, persist=True):
+    """
+    Loads the polygons in a shapefile into a PolygonIndex. When persisting, the index is stored next to the shapefile
+    and reused as long as the shapefile is unchanged.
+    :param shapefile_path: The path to the shapefile (.shp).
+    :param persist: Read and write the index file next to the shapefile.
+    :return: A PolygonIndex.
+    """
+    index_path = shapefile_path + INDEX_SUFFIX
+    if persist and os.path.isfile(index_path):
+        index = PolygonIndex.load(index_path, source_path=shapefile_path)
+        if index is not None:
+            return index
+    index = PolygonIndex(load_shapefile(shapefile_path))
+    if persist:
+        try:
+            index.save(index_path, source_path=shapefile_path)
+        except OSError as e:
+            print(f"WARNING: could not save the polygon index to {index_path}: {e}")
+    return index
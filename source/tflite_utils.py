@@ -0,0 +1,108 @@
+import glob
+import os
+import random
+import numpy as np
+import tensorflow as tf
+import gdal
+
+"""
+Export of trained models to TFLite (optionally quantized) and a TFLite backend for making predictions on CPUs.
+"""
+
+QUANTIZATIONS = ("none", "float16", "int8")
+
+
+def _representative_dataset(data_folder_path, n_tiles, input_channels):
+    # Normalized tiles from the images folder of a dataset, used to calibrate the int8 quantization
+    paths = sorted(glob.glob(os.path.join(data_folder_path, "images", "*.tif")))
+    random.Random(0).shuffle(paths)
+    for path in paths[:n_tiles]:
+        image_ds = gdal.Open(path)
+        image = image_ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
+        image_ds = None
+        image /= (2 ** 8 - 1)
+        yield [np.repeat(image[np.newaxis, :, :, np.newaxis], input_channels, axis=-1)]
+
+
+def export_tflite(model, output_path, quantization="float16", calibration_data_folder=None, n_calibration_tiles=100):
+    """
+    Converts a keras model to TFLite and writes it to file.
+    :param model: A keras model.
+    :param output_path: The path of the TFLite model (.tflite file).
+    :param quantization: none: float32 weights. float16: float16 weights. int8: int8 weights and activations,
+    calibrated on tiles from the calibration data folder.
+    :param calibration_data_folder: A dataset folder with a subfolder called images with tiles in .tif format. Needed for
+    int8 quantization.
+    :param n_calibration_tiles: The number of tiles used for the calibration.
+    :return: Nothing
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"The quantization must be one of {QUANTIZATIONS}, it was {quantization}")
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        if calibration_data_folder is None:
+            raise ValueError("int8 quantization needs a calibration data folder")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: _representative_dataset(calibration_data_folder,
+                                                                           n_calibration_tiles,
+                                                                           model.input_shape[-1])
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(output_path, "wb") as f:
+        f.write(converter.convert())
+
+
+class TFLiteModel:
+    """
+    A TFLite model with the parts of the keras model interface that are used for making predictions
+    (input_shape, output_shape, predict_on_batch and predict).
+    """
+
+    def __init__(self, model_file_path):
+        """
+        :param model_file_path: The path to the TFLite model (.tflite file).
+        """
+        self.interpreter = tf.lite.Interpreter(model_path=model_file_path)
+        self.interpreter.allocate_tensors()
+        self._update_details()
+        self.input_shape = (None,) + tuple(self._input_details["shape"][1:])
+        self.output_shape = (None,) + tuple(self._output_details["shape"][1:])
+
+    def _update_details(self):
+        self._input_details = self.interpreter.get_input_details()[0]
+        self._output_details = self.interpreter.get_output_details()[0]
+
+    def predict_on_batch(self, batch):
+        """
+        :param batch: A numpy array with shape (n, image_size, image_size, channels) with normalized images.
+        :return: A float32 numpy array with the softmax output of the model.
+        """
+        if self._input_details["shape"][0] != batch.shape[0]:
+            self.interpreter.resize_tensor_input(self._input_details["index"], batch.shape)
+            self.interpreter.allocate_tensors()
+            self._update_details()
+
+        # Quantize the input if the model takes integers
+        input_type = self._input_details["dtype"]
+        if input_type != np.float32:
+            scale, zero_point = self._input_details["quantization"]
+            batch = np.round(batch / scale + zero_point).astype(input_type)
+        self.interpreter.set_tensor(self._input_details["index"], batch)
+        self.interpreter.invoke()
+        output = self.interpreter.get_tensor(self._output_details["index"])
+        if self._output_details["dtype"] != np.float32:
+            scale, zero_point = self._output_details["quantization"]
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+    def predict(self, data, batch_size=1):
+        """
+        :param data: A numpy array with shape (n, image_size, image_size, channels) with normalized images.
+        :param batch_size: The number of images in each call to the interpreter.
+        :return: A float32 numpy array with the softmax output of the model.
+        """
+        outputs = [self.predict_on_batch(data[i:i + batch_size].astype(np.float32))
+                   for i in range(0, len(data), batch_size)]
+        return np.concatenate(outputs, axis=0)
@@ -0,0 +1,280 @@
+import glob
+import json
+import os
+import re
+import sys
+import numpy as np
+import gdal
+
+"""
+A dataset format with the tiles in a few big binary shards instead of two small GeoTIFFs per tile. A shard is a raw
+uint8 block of images and a raw uint8 block of labels, both with shape (n_tiles, tile_size, tile_size), that are read
+with numpy memmap, so a tile is only read from disk when it is used. A json index next to the shards has the name, big
+image, offsets and geo transform of every tile.
+
+Layout of a tile store folder:
+index.json
+shard_00000.images.bin, shard_00000.labels.bin
+shard_00001.images.bin, shard_00001.labels.bin
+...
+
+Usage: python tile_store.py data_folder output_folder
+Converts a dataset folder with images and labels subfolders with tiles in .tif format to a tile store.
+"""
+
+INDEX_NAME = "index.json"
+FORMAT_VERSION = 1
+# The names given to the tiles by data_processing.divide_image
+TILE_NAME_PATTERN = re.compile(r"^(?P<big_image>.+)_n_(?P<north>\d+)_e_(?P<east>\d+)$")
+
+
+def is_tile_store(folder_path):
+    """
+    :param folder_path: The path to a dataset folder.
+    :return: True if the folder is a tile store.
+    """
+    return os.path.isfile(os.path.join(folder_path, INDEX_NAME))
+
+
+def _shard_paths(folder_path, shard):
+    prefix = os.path.join(folder_path, f"shard_{shard:05d}")
+    return prefix + ".images.bin", prefix + ".labels.bin"
+
+
+def _as_uint8(array, what):
+    if array.dtype == np.uint8:
+        return array
+    if np.min(array) < 0 or np.max(array) > 255:
+        raise ValueError(f"The {what} has values outside the range [0, 255] and can not be stored as uint8")
+    return array.astype(np.uint8)
+
+
+class TileStoreWriter:
+    """
+    Writes tiles to a tile store. The index is written when the writer is closed.
+    """
+
+    def __init__(self, folder_path, tiles_per_shard=1024):
+        """
+        :param folder_path: The folder of the tile store. Existing shards in the folder are overwritten.
+        :param tiles_per_shard: The max number of tiles in a shard.
+        """
+        os.makedirs(folder_path, exist_ok=True)
+        self.folder_path = folder_path
+        self.tiles_per_shard = tiles_per_shard
+        self.image_size = None
+        self.label_size = None
+        self.shard_sizes = []
+        self.tiles = {"name": [], "big_image": [], "north_offset": [], "east_offset": [], "geo_transform": [],
+                      "label_geo_transform": []}
+        self.projections = {}
+        self._image_file = None
+        self._label_file = None
+
+    def _next_shard(self):
+        self._close_shard()
+        image_path, label_path = _shard_paths(self.folder_path, len(self.shard_sizes))
+        self._image_file = open(image_path, "wb")
+        self._label_file = open(label_path, "wb")
+        self.shard_sizes.append(0)
+
+    def _close_shard(self):
+        if self._image_file is not None:
+            self._image_file.close()
+            self._label_file.close()
+            self._image_file = None
+            self._label_file = None
+
+    def add(self, data, labels, name, big_image, geo_transform, projection, north_offset=-1, east_offset=-1,
+            label_geo_transform=None):
+        """
+        Adds a tile to the store.
+        :param data: A numpy array with shape (image_size, image_size) with 8 bit values.
+        :param labels: A numpy array with shape (label_size, label_size) with the class ids.
+        :param name: The name of the tile, without file extension.
+        :param big_image: The name of the big image the tile comes from.
+        :param geo_transform: The geo transform of the tile. See gdal doc for more info
+        :param projection: The Geo projection of the tile (wkt). See gdal doc for more info.
+        :param north_offset: The offset in pixels from the most north point of the big image. -1 if not known.
+        :param east_offset: The offset in pixels from the most east point of the big image. -1 if not known.
+        :param label_geo_transform: The geo transform of the labels, if it is not the same as the geo transform.
+        :return: Nothing
+        """
+        if self.image_size is None:
+            self.image_size = data.shape[0]
+            self.label_size = labels.shape[0]
+        if data.shape != (self.image_size, self.image_size) or labels.shape != (self.label_size, self.label_size):
+            raise ValueError(f"All the tiles in a store must have the same size, the first was {self.image_size} "
+                             f"with labels {self.label_size}, {name} is {data.shape} with labels {labels.shape}")
+        if len(self.shard_sizes) == 0 or self.shard_sizes[-1] == self.tiles_per_shard:
+            self._next_shard()
+        self._image_file.write(np.ascontiguousarray(_as_uint8(data, f"image {name}")).tobytes())
+        self._label_file.write(np.ascontiguousarray(_as_uint8(labels, f"label {name}")).tobytes())
+        self.shard_sizes[-1] += 1
+
+        self.tiles["name"].append(name)
+        self.tiles["big_image"].append(big_image)
+        self.tiles["north_offset"].append(int(north_offset))
+        self.tiles["east_offset"].append(int(east_offset))
+        self.tiles["geo_transform"].append([float(value) for value in geo_transform])
+        if label_geo_transform is None:
+            label_geo_transform = geo_transform
+        self.tiles["label_geo_transform"].append([float(value) for value in label_geo_transform])
+        if not isinstance(projection, str):
+            # An osr.SpatialReference
+            projection = projection.ExportToWkt()
+        self.projections[big_image] = projection
+
+    def add_training_image(self, image, big_image=None):
+        """
+        Adds a data_processing.TrainingImage to the store.
+        :param image: A TrainingImage, e.g. from data_processing.divide_image.
+        :param big_image: The name of the big image. Defaults to the name of the image without the offsets.
+        :return: Nothing
+        """
+        name = image.name.replace(".tif", "")
+        if big_image is None:
+            match = TILE_NAME_PATTERN.match(name)
+            big_image = match.group("big_image") if match is not None else name
+        north_offset = image.north_offset if image.north_offset is not None else -1
+        east_offset = image.east_offset if image.east_offset is not None else -1
+        self.add(image.data, image.labels, name, big_image, image.geo_transform, image.projection,
+                 north_offset=north_offset, east_offset=east_offset, label_geo_transform=image.label_geo_transform)
+
+    def add_grids(self, image_grid, label_grid):
+        """
+        Adds the tiles of a big image, see data_processing.tile_image.
+        :param image_grid: A tiling.TileGrid with the image tiles.
+        :param label_grid: A tiling.TileGrid with the label tiles.
+        :return: Nothing
+        """
+        for i in range(len(image_grid)):
+            north_offset, east_offset = image_grid.offsets[i]
+            self.add(image_grid[i], label_grid[i], image_grid.tile_name(i), image_grid.name,
+                     image_grid.tile_geo_transform(i), image_grid.projection, north_offset=north_offset,
+                     east_offset=east_offset, label_geo_transform=label_grid.tile_geo_transform(i))
+
+    def close(self):
+        """
+        Closes the last shard and writes the index.
+        :return: Nothing
+        """
+        self._close_shard()
+        index = {"version": FORMAT_VERSION, "image_size": self.image_size, "label_size": self.label_size,
+                 "shard_sizes": self.shard_sizes, "projections": self.projections, "tiles": self.tiles}
+        # Write the index last and in one step, so a store without a complete index is never opened
+        index_path = os.path.join(self.folder_path, INDEX_NAME)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+
+class TileStore:
+    """
+    Reads a tile store. The tiles are memmap slices of the shards, nothing is read from disk before it is used.
+    """
+
+    def __init__(self, folder_path):
+        """
+        :param folder_path: The folder of the tile store.
+        """
+        with open(os.path.join(folder_path, INDEX_NAME), "r") as f:
+            index = json.load(f)
+        if index["version"] != FORMAT_VERSION:
+            raise Exception(f"The tile store {folder_path} has version {index['version']}, expected {FORMAT_VERSION}")
+        self.folder_path = folder_path
+        self.image_size = index["image_size"]
+        self.label_size = index["label_size"]
+        self.shard_sizes = index["shard_sizes"]
+        self.projections = index["projections"]
+        tiles = index["tiles"]
+        self.names = tiles["name"]
+        self.big_images = tiles["big_image"]
+        self.offsets = np.stack([tiles["north_offset"], tiles["east_offset"]], axis=1).astype(np.int32) \
+            if len(self.names) > 0 else np.zeros((0, 2), dtype=np.int32)
+        self.geo_transforms = np.array(tiles["geo_transform"], dtype=np.float64).reshape(-1, 6)
+        self.label_geo_transforms = np.array(tiles["label_geo_transform"], dtype=np.float64).reshape(-1, 6)
+        # Tile i is tile i - shard_starts[shard] in its shard
+        self.shard_starts = np.concatenate([[0], np.cumsum(self.shard_sizes)]).astype(np.int64)
+        self._shards = [None] * len(self.shard_sizes)
+
+    def __len__(self):
+        return len(self.names)
+
+    def shard(self, shard):
+        """
+        :param shard: The index of the shard.
+        :return: A tuple with (images, labels), uint8 memmaps with shape (n_tiles, size, size).
+        """
+        if self._shards[shard] is None:
+            image_path, label_path = _shard_paths(self.folder_path, shard)
+            n_tiles = self.shard_sizes[shard]
+            self._shards[shard] = (np.memmap(image_path, dtype=np.uint8, mode="r",
+                                             shape=(n_tiles, self.image_size, self.image_size)),
+                                   np.memmap(label_path, dtype=np.uint8, mode="r",
+                                             shape=(n_tiles, self.label_size, self.label_size)))
+        return self._shards[shard]
+
+    def _locate(self, i):
+        if i < 0:
+            i += len(self)
+        shard = int(np.searchsorted(self.shard_starts, i, side="right")) - 1
+        return shard, i - int(self.shard_starts[shard])
+
+    def image(self, i):
+        """
+        :param i: The index of the tile.
+        :return: A uint8 memmap slice with shape (image_size, image_size).
+        """
+        shard, j = self._locate(i)
+        return self.shard(shard)[0][j]
+
+    def labels(self, i):
+        """
+        :param i: The index of the tile.
+        :return: A uint8 memmap slice with shape (label_size, label_size).
+        """
+        shard, j = self._locate(i)
+        return self.shard(shard)[1][j]
+
+    def projection(self, i):
+        """
+        :param i: The index of the tile.
+        :return: The Geo projection of the tile (wkt).
+        """
+        return self.projections[self.big_images[i]]
+
+
+def convert_geotiff_dataset(data_folder_path, store_folder_path, tiles_per_shard=1024):
+    """
+    Converts a dataset folder with tiles in .tif format to a tile store.
+    :param data_folder_path: Path to the folder with a subfolders called images and labels, see model_utils.load_dataset.
+    :param store_folder_path: The folder of the new tile store.
+    :param tiles_per_shard: The max number of tiles in a shard.
+    :return: The number of tiles in the store.
+    """
+    writer = TileStoreWriter(store_folder_path, tiles_per_shard=tiles_per_shard)
+    paths = sorted(glob.glob(os.path.join(data_folder_path, "images", "*.tif")))
+    for path in paths:
+        name = os.path.split(path)[-1].replace(".tif", "")
+        image_ds = gdal.Open(path)
+        label_ds = gdal.Open(os.path.join(data_folder_path, "labels", name + ".tif"))
+        match = TILE_NAME_PATTERN.match(name)
+        if match is not None:
+            big_image, north_offset, east_offset = match.group("big_image"), match.group("north"), match.group("east")
+        else:
+            big_image, north_offset, east_offset = name, -1, -1
+        writer.add(image_ds.GetRasterBand(1).ReadAsArray(), label_ds.GetRasterBand(1).ReadAsArray(), name,
+                   big_image, image_ds.GetGeoTransform(), image_ds.GetProjection(), north_offset=north_offset,
+                   east_offset=east_offset, label_geo_transform=label_ds.GetGeoTransform())
+        image_ds = None
+        label_ds = None
+    writer.close()
+    return len(paths)
+
+
+if __name__ == '__main__':
+    data_folder = sys.argv[1]
+    output_folder = sys.argv[2]
+    n_tiles = convert_geotiff_dataset(data_folder, output_folder)
+    print(f"Wrote {n_tiles} tiles to the tile store {output_folder}")
@@ -0,0 +1,120 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+"""
+Tiling of big images without copies. A TileGrid keeps the big image, one strided view over it with every possible
+tile window, and the offsets of the tiles as a compact numpy array. A tile is a view into the big image, and the geo
+transform and name of a tile are only computed when they are asked for.
+"""
+
+
+def window_view(array, tile_size):
+    """
+    A read only view with every tile_size x tile_size window of the array, without copying the array.
+    :param array: A numpy array with shape (height, width).
+    :param tile_size: The size of the windows in pixels.
+    :return: A numpy array view with shape (height - tile_size + 1, width - tile_size + 1, tile_size, tile_size) where
+    view[north_offset, east_offset] is the window with its top left corner at the offsets.
+    """
+    if array.shape[0] < tile_size or array.shape[1] < tile_size:
+        raise ValueError(f"The array {array.shape} is smaller than the tile size ({tile_size} pixels)")
+    row_stride, column_stride = array.strides
+    return as_strided(array, shape=(array.shape[0] - tile_size + 1, array.shape[1] - tile_size + 1,
+                                    tile_size, tile_size),
+                      strides=(row_stride, column_stride, row_stride, column_stride), writeable=False)
+
+
+class TileGrid:
+    """
+    The tiles of a big image. Indexing a TileGrid gives a tile (a view into the big image), so it can be used where a
+    list or an array of tiles is expected, e.g. in model_utils.predict_tiles.
+    """
+
+    def __init__(self, array, tile_size, offsets, geo_transform=None, projection=None, name=""):
+        """
+        :param array: A numpy array with shape (height, width) with the big image.
+        :param tile_size: The size of the tiles in pixels.
+        :param offsets: A numpy array with shape (n_tiles, 2) with the (north, east) offsets of the tiles in pixels.
+        :param geo_transform: The geo transform of the big image. See gdal doc for more info.
+        :param projection: The Geo projection of the big image. See gdal doc for more info.
+        :param name: The name of the big image, used to name the tiles.
+        """
+        self.array = array
+        self.tile_size = tile_size
+        self.offsets = np.asarray(offsets, dtype=np.int32).reshape(-1, 2)
+        self.geo_transform = geo_transform
+        self.projection = projection
+        self.name = name
+        self.windows = window_view(array, tile_size)
+
+    @classmethod
+    def from_offsets(cls, array, tile_size, north_offsets, east_offsets, **kwargs):
+        """
+        A grid with a tile at every combination of the north and east offsets, row by row.
+        :param array: A numpy array with shape (height, width) with the big image.
+        :param tile_size: The size of the tiles in pixels.
+        :param north_offsets: The offsets of the tile rows in pixels.
+        :param east_offsets: The offsets of the tile columns in pixels.
+        :param kwargs: geo_transform, projection and name, see __init__.
+        :return: A TileGrid.
+        """
+        north, east = np.meshgrid(north_offsets, east_offsets, indexing="ij")
+        return cls(array, tile_size, np.stack([north.ravel(), east.ravel()], axis=1), **kwargs)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        north_offset, east_offset = self.offsets[i]
+        return self.windows[north_offset, east_offset]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def select(self, indices):
+        """
+        :param indices: A bool mask or an array of indices of the tiles to keep.
+        :return: A TileGrid with the selected tiles, sharing the big image with this grid.
+        """
+        return TileGrid(self.array, self.tile_size, self.offsets[indices], geo_transform=self.geo_transform,
+                        projection=self.projection, name=self.name)
+
+    def crop(self, margin):
+        """
+        :param margin: The number of pixels removed from each side of the tiles.
+        :return: A TileGrid with the center of each tile, sharing the big image with this grid.
+        """
+        return TileGrid(self.array, self.tile_size - 2 * margin, self.offsets + margin,
+                        geo_transform=self.geo_transform, projection=self.projection, name=self.name)
+
+    def to_array(self, out=None):
+        """
+        Copies the tiles into one array, e.g. to build a dataset.
+        :param out: An optional preallocated numpy array with shape (n_tiles, tile_size, tile_size) to copy into.
+        :return: A numpy array with shape (n_tiles, tile_size, tile_size).
+        """
+        if out is None:
+            out = np.empty((len(self), self.tile_size, self.tile_size), dtype=self.array.dtype)
+        for i in range(len(self)):
+            out[i] = self[i]
+        return out
+
+    def tile_geo_transform(self, i):
+        """
+        :param i: The index of the tile.
+        :return: A list with the geo transform of the tile.
+        """
+        north_offset, east_offset = self.offsets[i]
+        geo_transform = list(self.geo_transform)
+        geo_transform[0] += int(east_offset) * self.geo_transform[1]  # East
+        geo_transform[3] += int(north_offset) * self.geo_transform[5]  # North
+        return geo_transform
+
+    def tile_name(self, i):
+        """
+        :param i: The index of the tile.
+        :return: The name of the tile, the name of the big image with the offsets of the tile.
+        """
+        north_offset, east_offset = self.offsets[i]
+        return self.name + f"_n_{north_offset}_e_{east_offset}"
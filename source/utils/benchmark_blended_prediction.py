@@ -0,0 +1,68 @@
+import gdal
+import numpy as np
+import os
+import sys
+import glob
+import time
+import tempfile
+import model_utils
+import metrics
+import data_processing
+import run_predictions
+
+"""
+Compare the blended sliding window prediction with the old prediction that reassembles non-overlapping tiles. Both
+throughput (megapixels per second) and miou against the label rasters are reported. The label rasters must have the same name as the big images.
+Usage: python benchmark_blended_prediction.py model_path image_folder label_folder [stride]
+"""
+
+
+def reassemble_prediction(model, big_image_path, batch_size=8):
+    # All the tiles, without the quality filter for training data
+    image_grid, _, _ = data_processing.tile_image(big_image_path, big_image_path, image_size=512, do_crop=False,
+                                                  do_overlap=False, filter_tiles=False)
+    predictions = model_utils.predict_tiles(model, image_grid, batch_size=batch_size)
+    big_image = np.full(image_grid.array.shape, data_processing.UNKNOWN_CLASS_ID, dtype=np.uint8)
+    for (north_offset, east_offset), prediction in zip(image_grid.offsets, predictions):
+        big_image[north_offset:north_offset + 512, east_offset:east_offset + 512] = prediction
+    return big_image
+
+
+def blended_prediction(model, big_image_path, stride, batch_size=8):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_path = os.path.join(temp_dir, "prediction.tif")
+        run_predictions.predict_big_image(model, big_image_path, output_path, batch_size=batch_size, stride=stride)
+        output_ds = gdal.Open(output_path)
+        prediction = output_ds.GetRasterBand(1).ReadAsArray()
+        output_ds = None
+    return prediction
+
+
+if __name__ == '__main__':
+    model_path = sys.argv[1]
+    image_folder = sys.argv[2]
+    label_folder = sys.argv[3]
+    stride = int(sys.argv[4]) if len(sys.argv) >= 5 else 256
+
+    model = model_utils.load_model(model_path)
+    num_classes = model.output_shape[-1]
+    methods = {"reassemble": lambda path: reassemble_prediction(model, path),
+               f"blended_stride_{stride}": lambda path: blended_prediction(model, path, stride)}
+    timings = {name: 0.0 for name in methods}
+    conf_mats = {name: metrics.ConfusionMatrix(num_classes) for name in methods}
+    n_pixels = 0
+
+    for image_path in glob.glob(os.path.join(image_folder, "*.tif")):
+        label_ds = gdal.Open(os.path.join(label_folder, os.path.split(image_path)[-1]))
+        label = label_ds.GetRasterBand(1).ReadAsArray()
+        label_ds = None
+        label = model_utils.replace_class(label, class_id=data_processing.UNKNOWN_CLASS_ID)
+        n_pixels += label.size
+        for name, method in methods.items():
+            start_time = time.time()
+            prediction = method(image_path)
+            timings[name] += time.time() - start_time
+            conf_mats[name].update(label, prediction)
+
+    for name in methods:
+        print(f"{name}: {n_pixels / 1e6 / timings[name]:.2f} megapixels/s, miou: {conf_mats[name].miou()}")
@@ -1,104 +1,196 @@
+import argparse
 import gdal
+import glob
+import json
+import multiprocessing
 import numpy as np
 import os
-import sys
-import glob
 from osgeo import ogr
-from osgeo import osr
-import model_utils
 import data_processing
-import sklearn.metrics
-
-if __name__ == '__main__':
-    # Specify file paths
-    bounding_poly_path = r"/media/kitkat/Seagate Expansion Drive/Master_project/nea_1962_test_set/shapefile_corrections/test_set_boundig_area.shp"
-    predicted_image_folder = r"/media/kitkat/Seagate Expansion Drive/Master_project/nea_1962_test_set/nea_1962_predictions"
-    corrected_image_folder = r"/media/kitkat/Seagate Expansion Drive/Master_project/nea_1962_test_set/raster_corrections"
-
-    # Load shapefile
-    driver = ogr.GetDriverByName("ESRI Shapefile")
-    ds = driver.Open(bounding_poly_path, 0)
-    layer = ds.GetLayer()
-    polys = []
-    for feature in layer:
-        geom = feature.GetGeometryRef().Clone()
-        ref = osr.SpatialReference()
-        ref.ImportFromEPSG(25833)
-        geom.AssignSpatialReference(ref)
-        polys.append(geom)
-
-    # Find intersecting images
-    predicted_image_paths = glob.glob(os.path.join(predicted_image_folder, "*.tif"))
-    corrected_image_paths = glob.glob(os.path.join(corrected_image_folder, "*.tif"))
-
-    predicted_image_overlapping_paths = []
-    corrected_image_overlapping_paths = []
-
-    for predicted_image_path in predicted_image_paths:
-        # Load the image
+import spatial_index
+import metrics
+
+"""
+Scores predictions against corrected rasters inside a test area given by bounding polygons. The scenes that overlap
+the test area are scored by a pool of worker processes. For each scene the mask is only rasterized over the envelope of
+the polygons overlapping it, only that window of the prediction and the correction is read, and the pixels are added to
+a confusion matrix. The confusion matrices of the scenes are added together, so the memory used does not grow with the
+size of the test area.
+Usage: python compute_test_score_in_area.py bounding_poly_path predicted_image_folder corrected_image_folder
+"""
+
+_worker_polygons = None
+
+
+def _init_worker(bounding_poly_path):
+    global _worker_polygons
+    _worker_polygons = spatial_index.load_index(bounding_poly_path)
+
+
+def envelope_window(geo_transform, envelope, x_size, y_size):
+    """
+    The pixel window of a raster covered by an envelope.
+    :param geo_transform: The geo transform of the raster, north up.
+    :param envelope: A (min_x, max_x, min_y, max_y) tuple, like the one from ogr's GetEnvelope.
+    :param x_size: The width of the raster in pixels.
+    :param y_size: The height of the raster in pixels.
+    :return: A tuple with (x_offset, y_offset, width, height) clipped to the raster, or None if the envelope does not
+    overlap the raster.
+    """
+    min_x, max_x, min_y, max_y = envelope
+    x_start = max(0, int(np.floor((min_x - geo_transform[0]) / geo_transform[1])))
+    x_end = min(x_size, int(np.ceil((max_x - geo_transform[0]) / geo_transform[1])))
+    y_start = max(0, int(np.floor((max_y - geo_transform[3]) / geo_transform[5])))
+    y_end = min(y_size, int(np.ceil((min_y - geo_transform[3]) / geo_transform[5])))
+    if x_end <= x_start or y_end <= y_start:
+        return None
+    return x_start, y_start, x_end - x_start, y_end - y_start
+
+
+def rasterize_mask(polygons, geo_transform, projection, window):
+    """
+    Rasterizes polygons over a window of a raster.
+    :param polygons: A list of gdal geometries.
+    :param geo_transform: The geo transform of the full raster.
+    :param projection: The projection of the raster.
+    :param window: A (x_offset, y_offset, width, height) tuple, see envelope_window.
+    :return: A bool numpy array with shape (height, width) that is True inside the polygons.
+    """
+    x_offset, y_offset, width, height = window
+    mask_ds = gdal.GetDriverByName("MEM").Create("", width, height, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform((geo_transform[0] + x_offset * geo_transform[1], geo_transform[1], geo_transform[2],
+                             geo_transform[3] + y_offset * geo_transform[5], geo_transform[4], geo_transform[5]))
+    mask_ds.SetProjection(projection)
+
+    poly_ds = ogr.GetDriverByName("Memory").CreateDataSource("bounding_polygons")
+    layer = poly_ds.CreateLayer("bounding_polygons", polygons[0].GetSpatialReference(), ogr.wkbPolygon)
+    for poly in polygons:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(poly)
+        layer.CreateFeature(feature)
+        feature.Destroy()
+    # MEM rasters start out filled with zeros
+    gdal.RasterizeLayer(mask_ds, (1,), layer, burn_values=(1,))
+    poly_ds.Destroy()
+    mask = mask_ds.GetRasterBand(1).ReadAsArray() > 0
+    mask_ds = None
+    return mask
+
+
+def score_scene(prediction_path, corrected_path, polygons, num_classes=5):
+    """
+    The confusion matrix of the pixels of a scene inside the polygons.
+    :param prediction_path: The path to the prediction raster.
+    :param corrected_path: The path to the corrected raster, on the same grid as the prediction.
+    :param polygons: A PolygonIndex with the bounding polygons of the test area.
+    :param num_classes: The number of classes.
+    :return: A metrics.ConfusionMatrix.
+    """
+    conf_mat = metrics.ConfusionMatrix(num_classes)
+    prediction_ds = gdal.Open(prediction_path)
+    corrected_ds = gdal.Open(corrected_path)
+    if prediction_ds is None or corrected_ds is None:
+        raise Exception(f"Could not open {prediction_path} or {corrected_path}")
+    geo_transform = prediction_ds.GetGeoTransform()
+    x_size, y_size = prediction_ds.RasterXSize, prediction_ds.RasterYSize
+    if (corrected_ds.RasterXSize, corrected_ds.RasterYSize) != (x_size, y_size) or \
+            not np.allclose(corrected_ds.GetGeoTransform(), geo_transform):
+        raise Exception(f"{corrected_path} is not on the same grid as {prediction_path}")
+
+    overlapping = polygons.query(data_processing.create_bounding_box(prediction_ds))
+    if len(overlapping) == 0:
+        return conf_mat
+    envelopes = np.array([poly.GetEnvelope() for poly in overlapping])
+    envelope = (envelopes[:, 0].min(), envelopes[:, 1].max(), envelopes[:, 2].min(), envelopes[:, 3].max())
+    window = envelope_window(geo_transform, envelope, x_size, y_size)
+    if window is None:
+        return conf_mat
+
+    # Only the pixels inside the polygons count
+    mask = rasterize_mask(overlapping, geo_transform, prediction_ds.GetProjection(), window)
+    prediction_array = prediction_ds.GetRasterBand(1).ReadAsArray(*window)
+    corrected_array = corrected_ds.GetRasterBand(1).ReadAsArray(*window)
+    prediction_ds = None
+    corrected_ds = None
+    return conf_mat.update(corrected_array, prediction_array, mask=mask)
+
+
+def _score_in_worker(task):
+    prediction_path, corrected_path, num_classes = task
+    return prediction_path, score_scene(prediction_path, corrected_path, _worker_polygons, num_classes).matrix
+
+
+def find_scene_pairs(polygons, predicted_image_folder, corrected_image_folder):
+    """
+    Finds the predictions that overlap the test area and their corrected rasters, which have the same names.
+    :param polygons: A PolygonIndex with the bounding polygons of the test area.
+    :param predicted_image_folder: The folder with the predictions (.tif).
+    :param corrected_image_folder: The folder with the corrected rasters (.tif).
+    :return: A list of (prediction path, corrected path) tuples.
+    """
+    pairs = []
+    for predicted_image_path in sorted(glob.glob(os.path.join(predicted_image_folder, "*.tif"))):
         image_ds = gdal.Open(predicted_image_path)
         image_bounding_box = data_processing.create_bounding_box(image_ds)
         image_ds = None
-        for poly in polys:
-            if poly.Intersects(image_bounding_box):
-                predicted_image_overlapping_paths.append(predicted_image_path)
-                if os.path.split(predicted_image_path)[-1] not in [os.path.split(path)[-1] for path in corrected_image_paths]:
-                    raise Exception(f"The corresponding corrected file did not exist.")
-                corrected_image_overlapping_paths.append(os.path.join(corrected_image_folder, os.path.split(predicted_image_path)[-1]))
-                break
-
-    # Compute confusion matrix
-    mem_driver = driver = gdal.GetDriverByName("MEM")
-    prediction_arrays = []
-    corrected_arrays = []
-    for i in range(len(predicted_image_overlapping_paths)):
-        prediction_ds = gdal.Open(predicted_image_overlapping_paths[i])
-        corrected_ds = gdal.Open(corrected_image_overlapping_paths[i])
-
-        # Make a mask with 1s at the location of pixels that should be included
-        mask_ds = mem_driver.Create("", prediction_ds.RasterXSize, prediction_ds.RasterYSize)
-        mask_ds.SetProjection(prediction_ds.GetProjection())
-        mask_ds.SetGeoTransform(prediction_ds.GetGeoTransform())
-        mask_ds.GetRasterBand(1).WriteArray(np.zeros((prediction_ds.RasterYSize, prediction_ds.RasterXSize)))
-        gdal.RasterizeLayer(mask_ds, (1,), layer, burn_values=(1,))
-        mask = mask_ds.GetRasterBand(1).ReadAsArray()
-        mask_mean = np.mean(mask)
-        prediction_array = prediction_ds.GetRasterBand(1).ReadAsArray()
-        corrected_array = corrected_ds.GetRasterBand(1).ReadAsArray()
-
-        # Flatten
-        prediction_array = prediction_array.flatten()
-        corrected_array = corrected_array.flatten()
-        mask = mask.flatten().astype(bool)
-
-        # Filter using the mask
-        prediction_array = prediction_array[mask]
-        corrected_array = corrected_array[mask]
-
-        prediction_arrays.append(prediction_array)
-        corrected_arrays.append(corrected_array)
-
-    predictions = np.concatenate(prediction_arrays)
-    corrections = np.concatenate(corrected_arrays)
-
-    a = np.mean(predictions)
-    b = np.max(predictions)
-    c = np.min(predictions)
-
-    d = np.mean(corrections)
-
-    miou = model_utils.miou(corrections, predictions, num_classes=5)
-
-    conf_mat = np.zeros((5, 5))
-    for i in range(len(prediction_arrays)):
-        conf_mat += sklearn.metrics.confusion_matrix(corrected_arrays[i], prediction_arrays[i], labels=[0, 1, 2, 3, 4])
-
-    print(miou)
-    print(np.sum([conf_mat[i][i] for i in range(5)] / np.sum(conf_mat)))
-    print(conf_mat)
-
-    np.savetxt(os.path.join("../../tests", "nea_1962_test_conf_mat.csv"), conf_mat, delimiter=",")
-
-
+        if polygons.intersects_any(image_bounding_box):
+            corrected_image_path = os.path.join(corrected_image_folder, os.path.split(predicted_image_path)[-1])
+            if not os.path.isfile(corrected_image_path):
+                raise Exception(f"The corresponding corrected file did not exist: {corrected_image_path}")
+            pairs.append((predicted_image_path, corrected_image_path))
+    return pairs
+
+
+def compute_score(bounding_poly_path, predicted_image_folder, corrected_image_folder, num_classes=5, n_workers=None):
+    """
+    Scores the predictions inside the test area.
+    :param bounding_poly_path: The shapefile with the polygons bounding the test area.
+    :param predicted_image_folder: The folder with the predictions (.tif).
+    :param corrected_image_folder: The folder with the corrected rasters (.tif) with the same names.
+    :param num_classes: The number of classes.
+    :param n_workers: The number of worker processes. Defaults to the number of cores, 1 scores in this process.
+    :return: A metrics.ConfusionMatrix with the pixels of all the scenes.
+    """
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    # Builds (or checks) the spatial index once, so the workers only have to load it
+    polygons = spatial_index.load_index(bounding_poly_path)
+    pairs = find_scene_pairs(polygons, predicted_image_folder, corrected_image_folder)
+    print(f"{len(pairs)} scenes overlap the test area")
+
+    conf_mat = metrics.ConfusionMatrix(num_classes)
+    if n_workers <= 1:
+        for i, (prediction_path, corrected_path) in enumerate(pairs):
+            conf_mat.merge(score_scene(prediction_path, corrected_path, polygons, num_classes))
+            print(f"[{i + 1}/{len(pairs)}] Scored {prediction_path}")
+        return conf_mat
+
+    tasks = [(prediction_path, corrected_path, num_classes) for prediction_path, corrected_path in pairs]
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(n_workers, initializer=_init_worker, initargs=(bounding_poly_path,)) as pool:
+        for i, (prediction_path, matrix) in enumerate(pool.imap_unordered(_score_in_worker, tasks, chunksize=1)):
+            conf_mat.merge(matrix)
+            print(f"[{i + 1}/{len(pairs)}] Scored {prediction_path}")
+    return conf_mat
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score predictions against corrected rasters inside a test area.")
+    parser.add_argument("bounding_poly_path", help="Shapefile with the polygons bounding the test area")
+    parser.add_argument("predicted_image_folder", help="Folder with the predictions (.tif files)")
+    parser.add_argument("corrected_image_folder", help="Folder with the corrected rasters with the same names")
+    parser.add_argument("--output", default=os.path.join("../../tests", "nea_1962_test_conf_mat.csv"),
+                        help="Path of the confusion matrix (.csv), the metrics are written next to it (.json)")
+    parser.add_argument("--num_classes", type=int, default=5, help="Number of classes")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, defaults to all cores")
+    args = parser.parse_args()
+
+    conf_mat = compute_score(args.bounding_poly_path, args.predicted_image_folder, args.corrected_image_folder,
+                             num_classes=args.num_classes, n_workers=args.workers)
+    print(conf_mat.miou())
+    print(conf_mat.pixel_accuracy())
+    print(conf_mat.matrix)
+
+    np.savetxt(args.output, conf_mat.matrix, delimiter=",")
+    with open(os.path.splitext(args.output)[0] + ".json", "w") as f:
+        json.dump(conf_mat.summary(), f, indent=4)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules in source are imported as top level modules, like the scripts do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source"))
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("gdal")
+import data_processing
+
+
+class _Raster:
+    # The part of a gdal raster that merge_labels_rasters reads
+    def __init__(self, array):
+        self.array = array
+
+    def GetRasterBand(self, index):
+        return self
+
+    def ReadAsArray(self):
+        return self.array
+
+
+def _merge_per_pixel(arrays):
+    # The per pixel loop merge_labels_rasters used before it was vectorized, kept as the reference
+    shape = next(array.shape for array in arrays if array is not None)
+    label_matrix = np.zeros(shape, dtype=int)
+    for i in range(shape[0]):
+        for j in range(shape[1]):
+            ids_at_pixel = [id for id, array in enumerate(arrays) if array is not None and array[i][j] > 0]
+            if len(ids_at_pixel) == 1:
+                label_matrix[i][j] = ids_at_pixel[0]
+            elif len(ids_at_pixel) == 0:
+                label_matrix[i][j] = data_processing.find_closest_pixel(i, j, arrays)
+            else:
+                id_count = [0] * len(arrays)
+                for id in ids_at_pixel:
+                    id_count[id] += 1
+                label_matrix[i][j] = np.argmax(id_count)
+    return label_matrix
+
+
+def _random_arrays(rng, shape, n_classes, density, none_classes=()):
+    return [None if class_id in none_classes else (rng.random(shape) < density).astype(np.int16)
+            for class_id in range(n_classes)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_merge_matches_per_pixel_loop_with_overlaps(seed):
+    rng = np.random.default_rng(seed)
+    # Dense enough that many pixels have more than one class
+    arrays = _random_arrays(rng, (23, 31), 5, density=0.3)
+    assert np.any(sum(array for array in arrays) > 1)
+    np.testing.assert_array_equal(data_processing.merge_label_arrays(arrays), _merge_per_pixel(arrays))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_merge_matches_per_pixel_loop_with_none_classes(seed):
+    rng = np.random.default_rng(seed)
+    arrays = _random_arrays(rng, (19, 27), 6, density=0.1, none_classes=(0, 3))
+    np.testing.assert_array_equal(data_processing.merge_label_arrays(arrays), _merge_per_pixel(arrays))
+
+
+def test_merge_matches_per_pixel_loop_with_empty_windows():
+    rng = np.random.default_rng(0)
+    # A few isolated pixels in a large empty raster, most windows have no class and default to the unknown class
+    arrays = _random_arrays(rng, (60, 70), 4, density=0.002, none_classes=(2,))
+    merged = data_processing.merge_label_arrays(arrays)
+    np.testing.assert_array_equal(merged, _merge_per_pixel(arrays))
+    assert np.any(merged == data_processing.UNKNOWN_CLASS_ID)
+
+
+def test_merge_matches_per_pixel_loop_near_the_border():
+    rng = np.random.default_rng(1)
+    # Classes only close to the border, where the search window shrinks (to nothing on the border itself)
+    arrays = _random_arrays(rng, (30, 30), 3, density=0.2)
+    for array in arrays:
+        array[3:-3, 3:-3] = 0
+    merged = data_processing.merge_label_arrays(arrays)
+    np.testing.assert_array_equal(merged, _merge_per_pixel(arrays))
+    # Empty border pixels have no window
+    is_empty = sum(array for array in arrays) == 0
+    assert np.all(merged[0][is_empty[0]] == data_processing.UNKNOWN_CLASS_ID)
+
+
+def test_merge_labels_rasters_uses_the_sorted_ids():
+    rng = np.random.default_rng(2)
+    arrays = _random_arrays(rng, (16, 16), 3, density=0.2)
+    # The position of the id in the sorted ids is the class, the missing id 1 is not a class
+    rasters = {4: _Raster(arrays[2]), 0: _Raster(arrays[0]), 2: _Raster(arrays[1]), 7: None}
+    np.testing.assert_array_equal(data_processing.merge_labels_rasters(rasters),
+                                  _merge_per_pixel(arrays + [None]))
+
+
+@pytest.mark.parametrize("strip_rows", [1, 3, 7])
+def test_neighborhood_majority_strips_match_per_pixel_loop(strip_rows):
+    rng = np.random.default_rng(3)
+    arrays = _random_arrays(rng, (29, 24), 4, density=0.05, none_classes=(1,))
+    is_empty = sum(array for array in arrays if array is not None) == 0
+    expected = _merge_per_pixel(arrays)[is_empty]
+    np.testing.assert_array_equal(data_processing._neighborhood_majority(arrays, is_empty, strip_rows=strip_rows),
+                                  expected)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip("gdal")
+from osgeo import ogr
+from osgeo import osr
+import data_processing
+
+GEO_TRANSFORM = (500000.0, 1.0, 0.0, 7000000.0, 0.0, -1.0)
+
+
+def _write_image(path, width=48, height=40):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(25833)
+    image_ds = gdal.GetDriverByName("GTiff").Create(path, width, height, 1, gdal.GDT_Byte)
+    image_ds.SetGeoTransform(GEO_TRANSFORM)
+    image_ds.SetProjection(srs.ExportToWkt())
+    image_ds = None
+
+
+def _box(left, top, right, bottom):
+    # A polygon from pixel coordinates of the image
+    x0, y0 = GEO_TRANSFORM[0], GEO_TRANSFORM[3]
+    return ogr.CreateGeometryFromWkt(f"POLYGON(({x0 + left} {y0 - top}, {x0 + right} {y0 - top}, "
+                                     f"{x0 + right} {y0 - bottom}, {x0 + left} {y0 - bottom}, "
+                                     f"{x0 + left} {y0 - top}))")
+
+
+def _read(path):
+    label_ds = gdal.Open(path)
+    labels = label_ds.GetRasterBand(1).ReadAsArray()
+    label_ds = None
+    return labels
+
+
+def test_single_pass_matches_per_class(tmp_path):
+    image_path = str(tmp_path / "image.tif")
+    _write_image(image_path)
+    # Overlapping polygons of different classes, gaps that are filled from the neighborhood, a class id that is not
+    # the position in the sorted ids (4), overlapping polygons of the same class and classes without polygons
+    poly_dict = {0: [_box(2, 2, 20, 18), _box(5, 5, 12, 30)],
+                 2: [_box(10, 10, 30, 30), _box(40, 0, 48, 6), _box(25, 25, 35, 35)],
+                 4: [_box(15, 5, 45, 25)],
+                 1: [],
+                 5: [_box(1000, 1000, 1010, 1010)]}
+    per_class_path = str(tmp_path / "per_class.tif")
+    single_pass_path = str(tmp_path / "single_pass.tif")
+    data_processing.create_raster_labels(image_path, poly_dict, per_class_path, single_pass=False)
+    data_processing.create_raster_labels(image_path, poly_dict, single_pass_path, single_pass=True)
+
+    per_class = _read(per_class_path)
+    np.testing.assert_array_equal(_read(single_pass_path), per_class)
+    # The classes are the positions of the ids in the sorted ids, 4 is at position 3
+    assert per_class[20, 40] == 3
+
+
+def test_single_pass_without_overlapping_polygons(tmp_path):
+    image_path = str(tmp_path / "image.tif")
+    _write_image(image_path)
+    label_path = str(tmp_path / "labels.tif")
+    data_processing.create_raster_labels(image_path, {0: [_box(1000, 1000, 1010, 1010)]}, label_path,
+                                         single_pass=True)
+    assert not (tmp_path / "labels.tif").exists()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_resolve_class_flags_matches_merge(seed):
+    rng = np.random.default_rng(seed)
+    arrays = [(rng.random((25, 33)) < density).astype(np.uint8) for density in (0.2, 0.0, 0.05, 0.3, 0.01)]
+    class_flags = sum(array.astype(np.uint8) << bit for bit, array in enumerate(arrays))
+    np.testing.assert_array_equal(data_processing.resolve_class_flags(class_flags, len(arrays)),
+                                  data_processing.merge_label_arrays(arrays))
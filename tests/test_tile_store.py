@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip("gdal")
+pytest.importorskip("tensorflow")
+from osgeo import osr
+import data_processing
+import model_utils
+import tile_store
+
+GEO_TRANSFORM = (500000.0, 1.0, 0.0, 7000000.0, 0.0, -1.0)
+
+
+def _write_raster(path, array):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(25833)
+    raster = gdal.GetDriverByName("GTiff").Create(path, array.shape[1], array.shape[0], 1, gdal.GDT_Byte)
+    raster.SetGeoTransform(GEO_TRANSFORM)
+    raster.SetProjection(srs.ExportToWkt())
+    raster.GetRasterBand(1).WriteArray(array)
+    raster = None
+
+
+def test_writer_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    store_path = str(tmp_path / "store")
+    # Few tiles per shard, so the tiles are spread over more than one shard
+    writer = tile_store.TileStoreWriter(store_path, tiles_per_shard=2)
+    tiles = []
+    for i in range(5):
+        data = rng.integers(0, 256, (16, 16)).astype(np.uint8)
+        labels = rng.integers(0, 6, (16, 16)).astype(np.uint8)
+        geo_transform = (GEO_TRANSFORM[0] + 16 * i,) + GEO_TRANSFORM[1:]
+        writer.add(data, labels, f"big_n_0_e_{16 * i}", "big", geo_transform, "projection", north_offset=0,
+                   east_offset=16 * i)
+        tiles.append((data, labels, geo_transform))
+    writer.close()
+
+    assert tile_store.is_tile_store(store_path)
+    dataset = model_utils.load_dataset(store_path)
+    assert len(dataset) == len(tiles)
+    for i, (image, (data, labels, geo_transform)) in enumerate(zip(dataset, tiles)):
+        np.testing.assert_array_equal(image.data, data)
+        np.testing.assert_array_equal(image.labels, labels)
+        assert image.name == f"big_n_0_e_{16 * i}.tif"
+        assert image.geo_transform == list(geo_transform)
+        assert image.projection == "projection"
+        assert (image.north_offset, image.east_offset) == (0, 16 * i)
+
+
+def test_divide_and_save_images_to_tile_store(tmp_path):
+    rng = np.random.default_rng(1)
+    image_path = str(tmp_path / "big.tif")
+    label_path = str(tmp_path / "big_labels.tif")
+    _write_raster(image_path, rng.integers(0, 256, (64, 96)).astype(np.uint8))
+    # No unknown class and more than one class, so every tile passes the quality check
+    _write_raster(label_path, rng.integers(0, 5, (64, 96)).astype(np.uint8))
+    store_path = str(tmp_path / "store")
+    data_processing.divide_and_save_images([image_path], [label_path], output_folder=store_path, image_size=32,
+                                           output_format="tile_store")
+
+    expected = data_processing.divide_image(image_path, label_path, image_size=32)
+    dataset = model_utils.load_dataset(store_path)
+    assert len(dataset) == len(expected) == 6
+    for image, expected_image in zip(dataset, expected):
+        np.testing.assert_array_equal(image.data, expected_image.data)
+        np.testing.assert_array_equal(image.labels, expected_image.labels)
+        assert image.name.replace(".tif", "") == expected_image.name.replace(".tif", "")
+        assert (image.north_offset, image.east_offset) == (expected_image.north_offset, expected_image.east_offset)
+        assert image.geo_transform == list(expected_image.geo_transform)